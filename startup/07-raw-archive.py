@@ -0,0 +1,263 @@
+print(__file__)
+
+import os
+import threading
+from contextlib import contextmanager, nullcontext, suppress
+
+import h5py
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Archived flat files (APB and trigger *.bin, pizzabox text and binary files)
+# are zstd-compressed next to the original location with this suffix and the
+# original is removed. The handlers read through open_raw/read_raw_array, so
+# they find either form. HDF5 files (Xspress3) are archived in place with the
+# HDF5 lzf filter and need nothing special to be read back.
+RAW_ARCHIVE_SUFFIX = '.zst'
+RAW_ARCHIVE_LEVEL = 3
+# size of the blocks that are compressed / decompressed at a time
+RAW_ARCHIVE_BLOCK = 2**22
+
+ARCHIVE_FLAT_SPECS = {'APB', 'APB_TRIGGER', 'PIZZABOX_AN_FILE_TXT', 'PIZZABOX_ENC_FILE_TXT',
+                      'PIZZABOX_ENC_FILE_BIN', 'PIZZABOX_DI_FILE_TXT'}
+ARCHIVE_HDF5_SPECS = {'XSP3'}
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ImportError('zstandard is required to read or write archived raw files')
+
+
+def raw_archive_path(fpath):
+    return str(fpath) + RAW_ARCHIVE_SUFFIX
+
+
+def raw_stat(fpath):
+    '''
+    os.stat of a raw file, or of its archived copy if only that exists.
+    '''
+    try:
+        return os.stat(fpath)
+    except FileNotFoundError:
+        return os.stat(raw_archive_path(fpath))
+
+
+def open_raw(fpath):
+    '''
+    Open a raw file for binary reading, the original if it exists, otherwise
+    its archived copy decompressed on the fly while reading.
+
+    Open file objects (e.g. io.BytesIO) are passed through and not closed.
+    '''
+    if not isinstance(fpath, (str, os.PathLike)):
+        return nullcontext(fpath)
+    if os.path.exists(fpath) or not os.path.exists(raw_archive_path(fpath)):
+        return open(fpath, 'rb')
+    _require_zstandard()
+    return zstandard.ZstdDecompressor().stream_reader(open(raw_archive_path(fpath), 'rb'),
+                                                      read_size=RAW_ARCHIVE_BLOCK, closefd=True)
+
+
+def read_raw_array(fpath, dtype):
+    '''
+    Return the content of a raw binary file as a 1d array of dtype.
+
+    The original file is memory-mapped. An archived file is decompressed
+    block by block straight into the array; trailing bytes that do not make
+    up a whole item are dropped in both cases.
+    '''
+    dtype = np.dtype(dtype)
+    if os.path.exists(fpath) or not os.path.exists(raw_archive_path(fpath)):
+        num_items = os.path.getsize(fpath) // dtype.itemsize
+        if not num_items:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(fpath, dtype=dtype, mode='r', shape=(num_items,))
+    _require_zstandard()
+    with open(raw_archive_path(fpath), 'rb') as f:
+        content_size = zstandard.get_frame_parameters(f.read(18)).content_size
+    if content_size < 0:
+        with open_raw(fpath) as f:
+            raw = b''.join(iter(lambda: f.read(RAW_ARCHIVE_BLOCK), b''))
+        return np.frombuffer(raw[:len(raw) - len(raw) % dtype.itemsize], dtype=dtype).copy()
+    data = np.zeros(content_size // dtype.itemsize, dtype=dtype)
+    buffer = data.view(np.uint8)
+    pos = 0
+    with open_raw(fpath) as f:
+        while pos < buffer.size:
+            block = f.read(min(RAW_ARCHIVE_BLOCK, buffer.size - pos))
+            if not block:
+                break
+            buffer[pos:pos + len(block)] = np.frombuffer(block, dtype=np.uint8)
+            pos += len(block)
+    return data
+
+
+def warm_raw_file(fpath, block_size=RAW_ARCHIVE_BLOCK):
+    '''
+    Read a raw file through once so that its pages are in the OS page cache
+    before a handler memory-maps or reads it. Archived files are skipped,
+    their handlers decompress them into memory anyway. Returns the number
+    of bytes read.
+    '''
+    if not os.path.exists(fpath):
+        return 0
+    nbytes = 0
+    buffer = bytearray(block_size)
+    with open(fpath, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            nbytes += n
+    return nbytes
+
+
+@contextmanager
+def atomic_write_path(fpath):
+    '''
+    Yield a temporary path next to fpath and move it over fpath when the
+    block completes, so readers never see a partly written file. If the
+    block fails the temporary file is removed and fpath is left untouched.
+
+    Example:
+        with atomic_write_path(fpath) as tmp_path, h5py.File(tmp_path, 'w') as f:
+            f['data'] = data
+    '''
+    tmp_path = f'{fpath}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        yield tmp_path
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, fpath)
+
+
+def archive_raw_file(fpath, level=RAW_ARCHIVE_LEVEL, remove=True):
+    '''
+    Compress a flat raw file into <fpath>.zst and remove the original.
+
+    The archive is written block by block through atomic_write_path, so an
+    interrupted run leaves the original untouched.
+    Returns the path of the archive.
+    '''
+    _require_zstandard()
+    archive_path = raw_archive_path(fpath)
+    cctx = zstandard.ZstdCompressor(level=level, write_content_size=True)
+    with atomic_write_path(archive_path) as tmp_path, open(fpath, 'rb') as src, open(tmp_path, 'wb') as dst:
+        cctx.copy_stream(src, dst, size=os.path.getsize(fpath),
+                         read_size=RAW_ARCHIVE_BLOCK, write_size=RAW_ARCHIVE_BLOCK)
+    if remove:
+        os.remove(fpath)
+    return archive_path
+
+
+def copy_hdf5_group(src, dst, copy_dataset, _copied=None):
+    '''
+    Copy the attributes and members of the HDF5 group src into dst, writing
+    every dataset with copy_dataset(dataset, dst_group, name).
+
+    Soft and external links are re-created as links, and hard links to an
+    object that was already copied (e.g. the /entry/data/data alias that
+    AreaDetector writes for the detector data) are re-created as hard links,
+    so the copy is not larger than the original.
+    '''
+    if _copied is None:
+        _copied = {}
+    for name, value in src.attrs.items():
+        dst.attrs[name] = value
+    for name in src:
+        link = src.get(name, getlink=True)
+        if isinstance(link, (h5py.SoftLink, h5py.ExternalLink)):
+            dst[name] = link
+            continue
+        item = src[name]
+        addr = h5py.h5o.get_info(item.id).addr
+        if addr in _copied:
+            dst[name] = dst.file[_copied[addr]]
+        elif isinstance(item, h5py.Group):
+            group = dst.create_group(name)
+            _copied[addr] = group.name
+            copy_hdf5_group(item, group, copy_dataset, _copied)
+        else:
+            if isinstance(item, h5py.Dataset):
+                copy_dataset(item, dst, name)
+            else:
+                src.copy(item, dst, name=name)
+            _copied[addr] = dst[name].name
+
+
+def _copy_dataset_compressed(item, dst, name):
+    if item.shape == () or item.size == 0 or item.dtype.kind not in 'biufc':
+        item.parent.copy(item, dst, name=name)
+        return
+    out = dst.create_dataset(name, shape=item.shape, dtype=item.dtype, chunks=item.chunks or True,
+                             maxshape=item.maxshape, fillvalue=item.fillvalue,
+                             compression='lzf', shuffle=True)
+    for attr_name, value in item.attrs.items():
+        out.attrs[attr_name] = value
+    rows = max(RAW_ARCHIVE_BLOCK // max(item.dtype.itemsize * (item.size // item.shape[0]), 1), 1)
+    for start in range(0, item.shape[0], rows):
+        out[start:start + rows] = item[start:start + rows]
+
+
+def _hdf5_compressed(f):
+    def check(name, item):
+        if isinstance(item, h5py.Dataset) and item.compression is not None:
+            return True
+    return bool(f.visititems(check))
+
+
+def archive_hdf5_file(fpath):
+    '''
+    Rewrite an HDF5 file with every dataset lzf-compressed (with shuffle),
+    copying the datasets in blocks. h5py decompresses lzf transparently, so
+    the handlers read the archived file as before.
+    '''
+    with atomic_write_path(fpath) as tmp_path, h5py.File(fpath, 'r') as src, h5py.File(tmp_path, 'w') as dst:
+        copy_hdf5_group(src, dst, _copy_dataset_compressed)
+    # handlers reopen the new file from the pool
+    h5_file_pool.release(fpath)
+    return fpath
+
+
+def archive_run(hdr, remove=True):
+    '''
+    Archive the raw files of a run (see RAW_ARCHIVE_SUFFIX).
+
+    Returns {resource uid: archived path}. Files that are already archived
+    are skipped, image detector files are left as they are.
+    '''
+    hdr = _as_header(hdr)
+    archived = {}
+    for uid, resource in run_resource_documents(hdr).items():
+        fpath = os.path.join(resource['root'], resource['resource_path'])
+        if resource['spec'] in ARCHIVE_FLAT_SPECS and os.path.exists(fpath):
+            archived[uid] = archive_raw_file(fpath, remove=remove)
+        elif resource['spec'] in ARCHIVE_HDF5_SPECS and os.path.exists(fpath):
+            with h5py.File(fpath, 'r') as f:
+                compressed = _hdf5_compressed(f)
+            if not compressed:
+                archived[uid] = archive_hdf5_file(fpath)
+    return archived
+
+
+def archive_runs(until, since=None, remove=True):
+    '''
+    Archive the raw files of all runs that started between since and until.
+
+    Example:
+        archive_runs(until='2024-01-01')
+    '''
+    archived = {}
+    for hdr in db(since=since, until=until):
+        try:
+            archived.update(archive_run(hdr, remove=remove))
+        except Exception as e:
+            print(f'Archiving run {hdr.start["uid"]} failed: {e!r}')
+    return archived
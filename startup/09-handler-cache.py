@@ -0,0 +1,435 @@
+print(__file__)
+
+import json
+import os
+import sys
+import threading
+import time as ttime
+from collections import OrderedDict, deque
+
+import h5py
+import numpy as np
+import pandas as pd
+
+
+def _nbytes(value, seen, depth):
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if isinstance(value, np.ndarray):
+        # count the buffer of views (and memmaps) once
+        base = value
+        while isinstance(base.base, np.ndarray):
+            base = base.base
+        if base is not value:
+            if id(base) in seen:
+                return 0
+            seen.add(id(base))
+        return base.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(deep=False)))
+    if isinstance(value, dict):
+        return sum(_nbytes(item, seen, depth + 1) for item in value.values())
+    if isinstance(value, (list, tuple, deque)):
+        return sum(_nbytes(item, seen, depth + 1) for item in value)
+    if depth < 3 and hasattr(value, '__dict__') and not isinstance(value, type) \
+            and not isinstance(value, (h5py.HLObject, h5py.File)):
+        # objects holding lazily loaded data, e.g. PooledH5Dataset or SparseFrameStack
+        return sum(_nbytes(item, seen, depth + 1) for item in vars(value).values())
+    return sys.getsizeof(value)
+
+
+def handler_nbytes(handler):
+    '''
+    Estimate of the memory held by a handler instance, measured on what it
+    holds right now, as most handlers load their data lazily.
+
+    Counts the numpy arrays (memory-mapped ones included, by their mapped
+    size) and DataFrames held in its attributes, in containers and in the
+    objects it holds. Handlers can report their own size with nbytes().
+    '''
+    nbytes = getattr(handler, 'nbytes', None)
+    if callable(nbytes):
+        return nbytes()
+    return _nbytes(handler, set(), 0)
+
+
+class HandlerCache:
+    '''
+    Process-wide LRU cache of handler instances with a memory budget.
+
+    Entries are evicted least-recently-used first whenever the estimated size
+    of the cached handlers goes above max_bytes or their number goes above
+    max_entries. Evicted handlers are closed and dropped from the
+    per-resource handler cache of db.reg as well, which would otherwise keep
+    them alive.
+
+    Handlers grow after they are built (blocks, decoded columns, edge
+    indices...), so their size is measured again on every hit and after
+    their calls (at most every remeasure_interval seconds per handler).
+    '''
+    def __init__(self, max_bytes=2 * 2**30, max_entries=128, remeasure_interval=1.0):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.remeasure_interval = remeasure_interval
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()  # key -> [handler, nbytes, time measured]
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, factory):
+        '''
+        Return the cached handler for key, creating it with factory() on a miss.
+        '''
+        if not self.enabled:
+            return factory()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self._measure(key, entry)
+                return entry[0]
+            self.misses += 1
+        # build outside of the lock so that slow file reads do not block other threads
+        handler = factory()
+        nbytes = handler_nbytes(handler)
+        if nbytes > self.max_bytes:
+            return handler
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry[0]
+            handler._handler_cache_key = key
+            self._entries[key] = [handler, nbytes, ttime.monotonic()]
+            self.nbytes += nbytes
+            self._evict()
+        return handler
+
+    def remeasure(self, handler, force=False):
+        '''
+        Measure a cached handler again, e.g. after it loaded data, and evict
+        handlers if the budget is exceeded.
+        '''
+        key = getattr(handler, '_handler_cache_key', None)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is handler:
+                self._entries.move_to_end(key)
+                self._measure(key, entry, force=force)
+
+    def touch(self, handler):
+        '''
+        Count a use of a cached handler that did not go through get(), e.g.
+        one that db.reg returned from its own cache.
+        '''
+        key = getattr(handler, '_handler_cache_key', None)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is handler:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self._measure(key, entry)
+
+    def _measure(self, key, entry, force=False):
+        now = ttime.monotonic()
+        if not force and now - entry[2] < self.remeasure_interval:
+            return
+        nbytes = handler_nbytes(entry[0])
+        self.nbytes += nbytes - entry[1]
+        entry[1], entry[2] = nbytes, now
+        if nbytes > self.max_bytes:
+            # too large to be cached at all, leave it open for whoever uses it now
+            del self._entries[key]
+            self.nbytes -= nbytes
+            self.evictions += 1
+            _forget_registry_handler(entry[0])
+        self._evict()
+
+    def _evict(self):
+        while self._entries and (self.nbytes > self.max_bytes or len(self._entries) > self.max_entries):
+            _, (handler, nbytes, _) = self._entries.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+            _discard_handler(handler)
+
+    def release(self, filename):
+        '''
+        Close and drop the handlers of a file, e.g. before it is deleted.
+        '''
+        path = os.path.abspath(str(filename))
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == path]:
+                handler, nbytes, _ = self._entries.pop(key)
+                self.nbytes -= nbytes
+                _discard_handler(handler)
+
+    def clear(self):
+        with self._lock:
+            while self._entries:
+                _, (handler, *_) = self._entries.popitem(last=False)
+                _discard_handler(handler)
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'nbytes': self.nbytes,
+                    'max_bytes': self.max_bytes,
+                    'max_entries': self.max_entries}
+
+
+def _forget_registry_handler(handler):
+    # db.reg keeps the handlers it builds in its own LRU keyed by resource uid
+    registry_handlers = getattr(db.reg, '_handler_cache', None)
+    if registry_handlers is not None:
+        for key, value in list(registry_handlers.items()):
+            if value is handler:
+                registry_handlers.pop(key, None)
+
+
+def _discard_handler(handler):
+    _forget_registry_handler(handler)
+    _close_handler(handler)
+
+
+def _close_handler(handler):
+    close = getattr(handler, 'close', None)
+    if close is not None:
+        try:
+            close()
+        except Exception as e:
+            print(f'Failed to close {handler}: {e}')
+
+
+handler_cache = HandlerCache()
+
+
+class H5FilePool:
+    '''
+    Process-wide pool of read-only h5py.File objects with at most max_open
+    files open at a time.
+
+    Handlers reading the same file share one h5py.File. When the limit is
+    reached the least-recently-used file is closed; handlers ask the pool
+    for the file on every access, so a closed file is simply reopened.
+
+    HDF5 cannot open a file with and without SWMR at the same time, so each
+    file is open once: a SWMR file also serves the readers that did not ask
+    for SWMR, and a file opened without it is reopened with SWMR when a
+    reader asks for it.
+    '''
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self.hits = 0
+        self.opens = 0
+        self.evictions = 0
+        self._files = OrderedDict()  # abspath -> h5py.File
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._files)
+
+    def get(self, filename, swmr=False):
+        key = os.path.abspath(filename)
+        with self._lock:
+            f = self._files.get(key)
+            if f is not None and f.id.valid:
+                if f.swmr_mode or not swmr:
+                    self._files.move_to_end(key)
+                    self.hits += 1
+                    return f
+                f.close()
+            self.opens += 1
+            f = h5py.File(filename, 'r', swmr=swmr)
+            self._files[key] = f
+            self._files.move_to_end(key)
+            while len(self._files) > self.max_open:
+                _, old = self._files.popitem(last=False)
+                self.evictions += 1
+                old.close()
+            return f
+
+    def release(self, filename):
+        '''
+        Close a file, e.g. before it is moved or rewritten.
+        '''
+        with self._lock:
+            f = self._files.pop(os.path.abspath(filename), None)
+            if f is not None:
+                f.close()
+
+    def clear(self):
+        with self._lock:
+            while self._files:
+                _, f = self._files.popitem(last=False)
+                f.close()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'opens': self.opens,
+                    'evictions': self.evictions,
+                    'open': len(self._files),
+                    'max_open': self.max_open}
+
+
+h5_file_pool = H5FilePool()
+
+
+class PooledH5FileMixin:
+    '''
+    Mixin for the databroker HDF5 handlers that keep their file in
+    self._file: the file is taken from h5_file_pool on every access instead
+    of being held open by the handler. Put it first in the bases.
+    '''
+    h5_swmr = False
+
+    @property
+    def _file(self):
+        return h5_file_pool.get(self._filename, swmr=self.h5_swmr)
+
+    @_file.setter
+    def _file(self, value):
+        # the base classes assign the file they were given or None, the pool owns the files
+        if value is not None:
+            self._filename = value.filename
+
+    def close(self):
+        # the file stays in the pool, other handlers may be reading it
+        self._dataset = None
+
+
+class PooledH5Dataset:
+    '''
+    Stand-in for an h5py.Dataset of a pooled file. open_dataset() is called
+    again whenever the pool has closed the file since the last access, so
+    the object stays usable for as long as the handler lives (e.g. in lazy
+    ImageStacks or dask arrays).
+    '''
+    def __init__(self, open_dataset):
+        self._open_dataset = open_dataset
+        self._dataset = None
+
+    @property
+    def dataset(self):
+        if self._dataset is None or not self._dataset.id.valid:
+            self._dataset = self._open_dataset()
+        return self._dataset
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __getitem__(self, key):
+        return self.dataset[key]
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.dataset[()], dtype=dtype)
+
+
+def _handler_key(spec, fpath, args, kwargs):
+    try:
+        st = raw_stat(fpath)
+        stamp = (st.st_size, st.st_mtime_ns)
+    except (OSError, TypeError):
+        stamp = None
+    return (spec, os.path.abspath(str(fpath)), stamp,
+            json.dumps([args, kwargs], sort_keys=True, default=str))
+
+
+_cached_handler_classes = {}
+
+
+def cached_handler(spec, handler_class, cache=handler_cache):
+    '''
+    Return a subclass of handler_class whose instances come from the cache.
+
+    Handlers are keyed by spec, full file path (root + resource path), the
+    file size and mtime, and the resource kwargs, so a file that changed on
+    disk gets a new handler. The instances are of a subclass of
+    handler_class that has the cache measure them again after each call.
+    '''
+    if getattr(handler_class, '_handler_cache', None) is not None:
+        return handler_class
+    key = (spec, handler_class, id(cache))
+    if key not in _cached_handler_classes:
+        def __call__(self, *args, **kwargs):
+            result = handler_class.__call__(self, *args, **kwargs)
+            cache.remeasure(self)
+            return result
+
+        measured_class = type(handler_class.__name__, (handler_class,),
+                              {'__call__': __call__,
+                               '__doc__': handler_class.__doc__,
+                               '__module__': handler_class.__module__})
+
+        def __new__(cls, fpath, *args, **kwargs):
+            return cache.get(_handler_key(spec, fpath, args, kwargs),
+                             lambda: measured_class(fpath, *args, **kwargs))
+
+        _cached_handler_classes[key] = type(handler_class.__name__, (handler_class,),
+                                            {'__new__': __new__,
+                                             '__doc__': handler_class.__doc__,
+                                             '__module__': handler_class.__module__,
+                                             '_handler_cache': cache})
+    return _cached_handler_classes[key]
+
+
+def release_resource_handlers(resource):
+    '''
+    Drop every handler of a resource document and close its file, so that
+    the file can be deleted or replaced: the handler_cache entries, the
+    per-resource handlers kept by db.reg and the h5_file_pool entry.
+    '''
+    root = resource.get('root', '')
+    root = getattr(db.reg, 'root_map', {}).get(root, root)
+    fpath = os.path.join(root, resource['resource_path'])
+    registry_handlers = getattr(db.reg, '_handler_cache', None)
+    if registry_handlers is not None:
+        for key in [key for key in list(registry_handlers) if key[0] == str(resource['uid'])]:
+            registry_handlers.pop(key, None)
+    handler_cache.release(fpath)
+    h5_file_pool.release(fpath)
+
+
+# Every handler registered from here on (11-handlers.py, 29-apb.py,
+# 30-apb_trigger.py, 40/41-xspress3*.py, 82-pilatus.py, ...) goes through the
+# cache; the RunRouters in 81/83 pick them up from db.reg.handler_reg.
+_register_handler = db.reg.register_handler
+
+
+def register_cached_handler(key, handler, overwrite=False):
+    return _register_handler(key, cached_handler(key, handler), overwrite=overwrite)
+
+
+db.reg.register_handler = register_cached_handler
+
+
+# db.reg hands out the handlers it has kept for a resource without building
+# them, count those uses in handler_cache so that its LRU order follows them.
+_get_spec_handler = db.reg.get_spec_handler
+
+
+def get_cached_spec_handler(resource):
+    lookups = handler_cache.hits + handler_cache.misses
+    handler = _get_spec_handler(resource)
+    if handler_cache.hits + handler_cache.misses == lookups:
+        handler_cache.touch(handler)
+    return handler
+
+
+db.reg.get_spec_handler = get_cached_spec_handler
@@ -3,6 +3,7 @@ import uuid
 from collections import namedtuple, deque
 import os
 import shutil
+import threading
 import time as ttime
 from ophyd import (ProsilicaDetector, SingleTrigger, Component as Cpt, Device,
                    EpicsSignal, EpicsSignalRO, ImagePlugin, StatsPlugin, ROIPlugin,
@@ -16,6 +17,133 @@ from ophyd import (Component as C, FormattedComponent as FC)
 
 from datetime import datetime
 
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+
+# line counts of pizzabox text files, keyed by (path, size, mtime), shared
+# by devices that write into the same file (the DualAdcFS twins)
+_line_counts = {}
+
+
+def count_lines(fpath, block_size=2**24):
+    """
+    Count the lines of a text file like len(list(f)) does, reading it in
+    large binary blocks. The count is cached until the file changes.
+    """
+    st = os.stat(fpath)
+    key = (os.path.abspath(fpath), st.st_size, st.st_mtime_ns)
+    if key not in _line_counts:
+        linecount = 0
+        last = b'\n'
+        with open(fpath, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                linecount += block.count(b'\n')
+                last = block[-1:]
+        # a last line without a newline still counts
+        _line_counts[key] = linecount + int(last != b'\n')
+    return _line_counts[key]
+
+
+# A file is taken as written as soon as the IOC reports that it stopped
+# writing it (the done callable of file_ready_status, e.g. the Ignore-RB or
+# Ena-Sts readback of the pizza box) or a local writer closed it. Failing
+# both, e.g. with no readback given, once its size and mtime have not changed
+# for FILE_READY_SETTLE seconds. The pizza box writes over NFS, where the size
+# and mtime seen by the client lag the writer by up to the attribute cache
+# time, so do not go below the 1 s the collect methods used to sleep unless a
+# shorter settle has been validated on the beamline file system.
+FILE_READY_SETTLE = 1.0
+FILE_READY_TIMEOUT = 10
+
+
+def _file_signature(fpath):
+    try:
+        st = os.stat(fpath)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def _watch_file(fpath, status, settle, done=None, poll_min=0.01, poll_max=0.25):
+    # inotify wakes the loop up on local writes and reports the close of the
+    # file; files written over the network do not raise events, so the
+    # readback and the stat polling below always run, backing off while
+    # nothing changes
+    inotify = None
+    if INotify is not None:
+        inotify = INotify()
+        try:
+            inotify.add_watch(os.path.dirname(fpath) or '.',
+                              inotify_flags.CREATE | inotify_flags.MODIFY |
+                              inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO)
+        except OSError:
+            inotify.close()
+            inotify = None
+    try:
+        name = os.path.basename(fpath)
+        poll = poll_min
+        signature = _file_signature(fpath)
+        stable_since = ttime.monotonic()
+        closed = False
+        while not status.done:
+            if signature is not None and done is not None and not closed:
+                try:
+                    closed = bool(done())
+                except Exception as e:
+                    print(f'Could not read whether {fpath} is done, waiting for it to settle: {e!r}')
+                    done = None
+            if closed and signature is not None:
+                break
+            wait = poll
+            if signature is not None:
+                wait = min(poll, max(stable_since + settle - ttime.monotonic(), 0))
+            if inotify is not None:
+                closed = any(event.name == name and event.mask & inotify_flags.CLOSE_WRITE
+                             for event in inotify.read(timeout=int(wait * 1000)))
+            else:
+                ttime.sleep(wait)
+            current = _file_signature(fpath)
+            now = ttime.monotonic()
+            if current != signature:
+                signature, stable_since, poll = current, now, poll_min
+            elif current is not None and now - stable_since >= settle:
+                break
+            else:
+                poll = min(poll * 2, poll_max)
+        if not status.done:
+            status.set_finished()
+    finally:
+        if inotify is not None:
+            inotify.close()
+
+
+def file_ready_status(fpath, settle=FILE_READY_SETTLE, timeout=FILE_READY_TIMEOUT, obj=None, done=None):
+    """
+    Return a Status that finishes as soon as fpath exists and done() returns
+    True (e.g. the IOC readback that it stopped writing), a local writer has
+    closed it, or its size has stopped changing for settle seconds. Fails
+    after timeout seconds.
+    """
+    status = Status(obj=obj, timeout=timeout)
+    threading.Thread(target=_watch_file, args=(fpath, status, settle, done),
+                     name='file-ready-watcher', daemon=True).start()
+    return status
+
+
+def wait_for_file(fpath, settle=FILE_READY_SETTLE, timeout=FILE_READY_TIMEOUT, done=None):
+    """
+    Block until fpath is written (see file_ready_status). Returns False if
+    it timed out.
+    """
+    try:
+        file_ready_status(fpath, settle=settle, timeout=timeout, done=done).wait()
+    except TimeoutError:
+        return False
+    return True
+
 print("init bpm")
 class BPM(ProsilicaDetector, SingleTrigger):
     image = Cpt(ImagePlugin, 'image1:')
@@ -104,6 +232,10 @@ class Encoder(Device):
         if self.connected:
             self.ignore_sel.put(1)
 
+    def _writer_stopped(self):
+        # the pizza box has stopped writing the file
+        return self.ignore_rb.get() == 1
+
 def make_filename(filename):
     '''
         Makes a rootpath, filepath pair
@@ -258,6 +390,14 @@ class EncoderFS(Encoder):
     "Encoder Device, when read, returns references to data in filestore."
     chunk_size = 2**20
     write_path_template = '/nsls2/data/qas-new/legacy/raw/pizza_box_data/%Y/%m/%d/'
+    # After complete(), transcode the text file into a packed binary file
+    # (see transcode_pizzabox_enc) and point the datum at it with the
+    # PIZZABOX_ENC_FILE_BIN spec. The text file is kept as it is.
+    binary_output = False
+    # Make one datum per chunk_size lines once the file is written, and mark
+    # the resource so that PizzaBoxEncHandlerTxt reads one chunk per datum
+    # instead of the whole file at once.
+    streaming = False
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -265,6 +405,7 @@ class EncoderFS(Encoder):
         self._resource_uid = None
         self._datum_counter = None
         self._datum_ids = None
+        self._datums_done = False
 
     # ## 3s scan testing staging method
     # def stage(self):
@@ -334,6 +475,7 @@ class EncoderFS(Encoder):
 
             # without the root, but with data path + date folders
             self._full_path = filepath
+            self._resource_path = resource_path
             # FIXME: Quick TEMPORARY fix for beamline disaster
             # we are writing the file to a temp directory in the ioc and
             # then moving it to the GPFS system.
@@ -346,10 +488,13 @@ class EncoderFS(Encoder):
             # self.filepath.put(self._ioc_full_path)
 
             self._resource_uid = str(uuid.uuid4())
+            resource_kwargs = {'chunk_size': self.chunk_size}
+            if self.streaming:
+                resource_kwargs['streaming'] = True
             resource = {'spec': 'PIZZABOX_ENC_FILE_TXT',
                         'root': os.path.join(ROOT_PATH, RAW_FILEPATH),
                         'resource_path': resource_path,
-                        'resource_kwargs': {'chunk_size': self.chunk_size},
+                        'resource_kwargs': resource_kwargs,
                         'path_semantics': {'posix': 'posix', 'nt': 'windows'}[os.name],
                         'uid': self._resource_uid}
             self._asset_docs_cache.append(('resource', resource))
@@ -404,6 +549,7 @@ class EncoderFS(Encoder):
         # before collect() is called. May need changes to RE to do this properly. - Dan A.
 
         self._datum_ids = []
+        self._datums_done = False
 
         datum_id = '{}/{}'.format(self._resource_uid,  next(self._datum_counter))
         datum = {'resource': self._resource_uid,
@@ -451,7 +597,66 @@ class EncoderFS(Encoder):
                       'shape': [-1, -1],
                       'dtype': 'array'}}}
 
+    def _transcode_to_binary(self):
+        """
+        Replace the text datum queued by complete() with one pointing to a
+        packed binary copy of the file. Keeps the text datum if that fails.
+        """
+        try:
+            transcode_pizzabox_enc(self._full_path)
+        except Exception as e:
+            print(f'Transcoding {self._full_path} failed, keeping the text file: {e!r}')
+            return False
+        text_datum_ids = set(self._datum_ids)
+        self._asset_docs_cache = deque((name, doc) for name, doc in self._asset_docs_cache
+                                       if not (name == 'datum' and doc['datum_id'] in text_datum_ids))
+        resource_uid = str(uuid.uuid4())
+        resource = {'spec': 'PIZZABOX_ENC_FILE_BIN',
+                    'root': os.path.join(ROOT_PATH, RAW_FILEPATH),
+                    'resource_path': self._resource_path + PIZZABOX_ENC_BIN_SUFFIX,
+                    'resource_kwargs': {'chunk_size': self.chunk_size},
+                    'path_semantics': {'posix': 'posix', 'nt': 'windows'}[os.name],
+                    'uid': resource_uid}
+        datum_id = '{}/{}'.format(resource_uid, 0)
+        datum = {'resource': resource_uid,
+                 'datum_kwargs': {"chunk_num": 0},
+                 'datum_id': datum_id}
+        self._asset_docs_cache.append(('resource', resource))
+        self._asset_docs_cache.append(('datum', datum))
+        self._datum_ids = [datum_id]
+        return True
+
+    def _make_chunk_datums(self):
+        """
+        Replace the chunk_num=0 datum queued by complete() with one datum per
+        chunk_size lines of the written file (streaming mode).
+        """
+        linecount = count_lines(self._full_path)
+        chunk_count = max(linecount // self.chunk_size + int(linecount % self.chunk_size != 0), 1)
+        text_datum_ids = set(self._datum_ids)
+        self._asset_docs_cache = deque((name, doc) for name, doc in self._asset_docs_cache
+                                       if not (name == 'datum' and doc['datum_id'] in text_datum_ids))
+        self._datum_ids = []
+        for chunk_num in range(chunk_count):
+            datum_id = '{}/{}'.format(self._resource_uid, next(self._datum_counter))
+            datum = {'resource': self._resource_uid,
+                     'datum_kwargs': {"chunk_num": chunk_num},
+                     'datum_id': datum_id}
+            self._asset_docs_cache.append(('datum', datum))
+            self._datum_ids.append(datum_id)
+
     def collect_asset_docs(self):
+        # The RunEngine asks for the asset documents before collect(), once
+        # the status of complete() is done, i.e. the file is closed.
+        if self._datum_ids and not self._datums_done:
+            self._datums_done = True
+            if self.binary_output or self.streaming:
+                # the whole text file is read below, the status of
+                # complete() does not wait for the pizza box to write it
+                wait_for_file(self._full_path, done=self._writer_stopped)
+            transcoded = self.binary_output and self._transcode_to_binary()
+            if self.streaming and not transcoded:
+                self._make_chunk_datums()
         items = list(self._asset_docs_cache)
         self._asset_docs_cache.clear()
         for item in items:
@@ -495,6 +700,10 @@ class DigitalInput(Device):
         if self.connected:
             self.ignore_sel.put(1)
 
+    def _writer_stopped(self):
+        # the pizza box has stopped writing the file
+        return self.ignore_rb.get() == 1
+
 
 class DIFS(DigitalInput):
     "Encoder Device, when read, returns references to data in filestore."
@@ -557,10 +766,10 @@ class DIFS(DigitalInput):
         # Create an Event document and a datum record in filestore for each line
         # in the text file.
         now = ttime.time()
-        ttime.sleep(1)  # wait for file to be written by pizza box
+        # wait for file to be written by pizza box
+        wait_for_file(self._full_path, done=self._writer_stopped)
         if os.path.isfile(self._full_path):
-            with open(self._full_path, 'r') as f:
-                linecount = len(list(f))
+            linecount = count_lines(self._full_path)
             chunk_count = linecount // self.chunk_size + int(linecount % self.chunk_size != 0)
             for chunk_num in range(chunk_count):
                 datum_uid = self._reg.register_datum(self.resource_uid,
@@ -671,6 +880,10 @@ class TriggerAdc(Device):
         #    pass
         #signal.alarm(0)
 
+    def _writer_stopped(self):
+        # the pizza box has stopped writing the file (Ena-Sel 1 stops it)
+        return self.enable_rb.get() == 1
+
 # needed for dual adc fs, this is the triggering Adc (missing volt and offset)
 class Adc(TriggerAdc):
     volt = Cpt(EpicsSignal, '}E-I')
@@ -745,13 +958,10 @@ class AdcFS(Adc):
         # Create an Event document and a datum record in filestore for each line
         # in the text file.
         now = ttime.time()
-        ttime.sleep(1)  # wait for file to be written by pizza box
+        # wait for file to be written by pizza box
+        wait_for_file(self._full_path, done=self._writer_stopped)
         if os.path.isfile(self._full_path):
-            with open(self._full_path, 'r') as f:
-                linecount = 0
-                for ln in f:
-                    linecount += 1
-
+            linecount = count_lines(self._full_path)
             chunk_count = linecount // self.chunk_size + int(linecount % self.chunk_size != 0)
             for chunk_num in range(chunk_count):
                 datum_uid = self._reg.register_datum(self.resource_uid,
@@ -930,19 +1140,10 @@ class DualAdcFS(TriggerAdc):
         now = ttime.time()
         #ttime.sleep(1)  # wait for file to be written by pizza box
         #if os.path.isfile(self._full_path):
-        for _ in range(5):
-            print(f'trying to open {self._full_path} round {_}')
-            try:
-                with open(self._full_path, 'r') as f:
-                    linecount = 0
-                    for ln in f:
-                        linecount += 1
-            except FileNotFoundError:
-                time.sleep(1)
-                continue
-            break
-        else:
+        # complete() has already waited for the file to be written
+        if not os.path.isfile(self._full_path) and not wait_for_file(self._full_path, done=self._writer_stopped):
             raise FileNotFoundError(self._full_path)
+        linecount = count_lines(self._full_path)
         chunk_count = linecount // self.chunk_size + int(linecount % self.chunk_size != 0)
         for chunk_num in range(chunk_count):
     
@@ -970,13 +1171,8 @@ class DualAdcFS(TriggerAdc):
             self._twin_adc._complete_adc = False
             self._complete_adc = False
 
-        status = DeviceStatus(self)
-        from threading import Timer
-        # wait on this complete function for 1 second
-        # hold on to the Timer so it will not be garbage collected
-        self.complete_timer = Timer(1, status.set_finished)
-        self.complete_timer.start()
-        return status
+        # finish as soon as the pizza box has stopped writing the file
+        return file_ready_status(self._full_path, obj=self, done=self._writer_stopped)
 
     def collect(self):
         """
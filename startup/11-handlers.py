@@ -1,7 +1,11 @@
 print(__file__)
 
+import hashlib
+import io
+import os
 from itertools import product
 
+import numpy as np
 import pandas as pd
 from databroker.assets.handlers import HandlerBase, Xspress3HDF5Handler, XS3_XRF_DATA_KEY
 
@@ -12,6 +16,254 @@ adc2counts = lambda x: ((int(x, 16) >> 8) - 0x40000) * fc \
 enc2counts = lambda x: int(x) if int(x) <= 0 else -(int(x) ^ 0xffffff - 1)
 
 
+def _hex_chars(values):
+    '''
+    Pack an array of strings into a (n, width) uint8 matrix of characters.
+    '''
+    values = np.asarray(values)
+    if values.dtype == object and values.size and isinstance(values[0], str):
+        # pizzabox writes every sample with the same width, so joining the
+        # strings gives a regular (n, width + 1) byte matrix much faster
+        # than converting each element to a numpy bytes scalar
+        width = len(values[0])
+        try:
+            joined = ('\n'.join(values) + '\n').encode('ascii')
+        except (TypeError, UnicodeEncodeError):
+            joined = b''
+        if len(joined) == values.size * (width + 1):
+            packed = np.frombuffer(joined, dtype=np.uint8).reshape(values.size, width + 1)
+            if (packed[:, width] == ord('\n')).all():
+                return packed[:, :width]
+    raw = np.asarray(values, dtype='S')
+    return raw.view(np.uint8).reshape(raw.size, raw.dtype.itemsize)
+
+
+def hex2uint32(values):
+    '''
+    Parse an array of hex strings (e.g. '0x0001a2b3') into a uint32 array.
+
+    The strings are packed into a fixed-width byte array and decoded with
+    array arithmetic, so the cost does not depend on a Python call per
+    sample. Characters that are not hex digits ('x' of the '0x' prefix,
+    trailing tabs, NUL padding) are skipped.
+    '''
+    chars = _hex_chars(values)
+    is_digit = ((chars - np.uint8(ord('0'))) < 10) | (((chars | np.uint8(0x20)) - np.uint8(ord('a'))) < 6)
+    nibbles = (chars & np.uint8(0xF)) + np.uint8(9) * (chars >> np.uint8(6))
+    if chars.shape[0] and (is_digit == is_digit[0]).all():
+        # every row has its digits at the same positions: pair the last 8 of
+        # them into bytes and read those as a big-endian uint32
+        digits = nibbles[:, is_digit[0]][:, -8:]
+        padded = np.zeros((chars.shape[0], 8), dtype=np.uint8)
+        padded[:, 8 - digits.shape[1]:] = digits
+        octets = (padded[:, 0::2] << np.uint8(4)) | padded[:, 1::2]
+        return octets.view('>u4').ravel().astype(np.uint32)
+    result = np.zeros(chars.shape[0], dtype=np.uint32)
+    for j in range(chars.shape[1]):
+        mask = is_digit[:, j]
+        result[mask] = (result[mask] << np.uint32(4)) | nibbles[mask, j]
+    return result
+
+
+def adc_raw2volts(raw):
+    '''
+    Convert raw uint32 adc words (as parsed by ``hex2uint32``) to volts.
+    '''
+    counts = (np.asarray(raw, dtype=np.uint32) >> np.uint32(8)).astype(np.int64)
+    counts = np.where(counts > 0x1FFFF, counts - 0x40000, counts)
+    return counts * fc
+
+
+def adc2counts_array(values):
+    '''
+    Vectorized version of ``adc2counts``, gives bit-for-bit identical volts.
+    '''
+    return adc_raw2volts(hex2uint32(values))
+
+
+def enc2counts_array(values):
+    '''
+    Vectorized version of ``enc2counts``.
+    '''
+    values = np.asarray(values, dtype=np.int64)
+    return np.where(values <= 0, values, -(values ^ (0xffffff - 1)))
+
+
+# Parsed pizzabox text files are kept as .npy files in this directory, keyed by
+# path, size and mtime, so that re-opening an old scan maps the binary copy
+# instead of parsing the text again. Set to None to disable the cache.
+PIZZABOX_CACHE_DIR = Path(appdirs.user_cache_dir(appname="bluesky")) / "pizzabox"
+# Size limit of the cache; the least recently used sidecars are deleted
+# whenever a new one takes it above the limit.
+PIZZABOX_CACHE_MAX_BYTES = 5 * 2**30
+
+
+def _pizzabox_cache_path(fpath, kind):
+    st = raw_stat(fpath)
+    key = f'{os.path.abspath(fpath)}:{st.st_size}:{st.st_mtime_ns}'
+    return Path(PIZZABOX_CACHE_DIR) / f'{kind}-{hashlib.sha1(key.encode()).hexdigest()}.npy'
+
+
+def cached_pizzabox_records(fpath, kind):
+    '''
+    Return the memory-mapped sidecar of a pizzabox text file, or None if the
+    file has not been cached yet.
+    '''
+    if PIZZABOX_CACHE_DIR is None:
+        return None
+    cache_path = _pizzabox_cache_path(fpath, kind)
+    if not cache_path.exists():
+        return None
+    try:
+        # the mtime of a sidecar is its last use, see prune_pizzabox_cache
+        os.utime(cache_path)
+        return np.load(cache_path, mmap_mode='r')
+    except (OSError, ValueError) as e:
+        print(f'Ignoring broken pizzabox cache {cache_path}: {e}')
+        return None
+
+
+def load_pizzabox_records(fpath, kind, parse):
+    '''
+    Return the structured array parsed from a pizzabox text file.
+
+    The first read parses the text with ``parse(fpath)`` and saves the result
+    to the sidecar cache; later reads memory-map the cached .npy file. Any
+    problem with the cache falls back to parsing the text.
+    '''
+    if PIZZABOX_CACHE_DIR is None:
+        return parse(fpath)
+    records = cached_pizzabox_records(fpath, kind)
+    if records is not None:
+        return records
+    cache_path = _pizzabox_cache_path(fpath, kind)
+    records = parse(fpath)
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_write_path(cache_path) as tmp_path, open(tmp_path, 'wb') as f:
+            np.save(f, records)
+    except OSError as e:
+        print(f'Could not write pizzabox cache {cache_path}: {e}')
+        return records
+    prune_pizzabox_cache()
+    return np.load(cache_path, mmap_mode='r')
+
+
+def prune_pizzabox_cache(max_bytes=None):
+    '''
+    Delete the least recently used sidecars until the cache takes at most
+    max_bytes (PIZZABOX_CACHE_MAX_BYTES by default). Returns the number of
+    bytes freed. clear_pizzabox_cache() empties the cache.
+    '''
+    if PIZZABOX_CACHE_DIR is None:
+        return 0
+    if max_bytes is None:
+        max_bytes = PIZZABOX_CACHE_MAX_BYTES
+    entries = []
+    for path in Path(PIZZABOX_CACHE_DIR).glob('*.npy'):
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    freed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
+        freed += size
+    return freed
+
+
+def clear_pizzabox_cache():
+    return prune_pizzabox_cache(max_bytes=0)
+
+
+def parse_pizzabox_an(fpath):
+    with open_raw(fpath) as f:
+        data = pd.read_csv(f, delimiter=" ", header=None)
+    ncols = len(data.columns) - 3
+    dtype = [('ts_s', 'i8'), ('ts_ns', 'i8'), ('index', 'i8')] + \
+            [(f'counts{j}', 'u4') for j in range(ncols)]
+    records = np.empty(len(data), dtype=dtype)
+    records['ts_s'] = data[0].values
+    records['ts_ns'] = data[1].values
+    records['index'] = data[2].values
+    for j in range(ncols):
+        records[f'counts{j}'] = hex2uint32(data[j + 3].values)
+    return records
+
+
+def _parse_pizzabox_ints(fpath, names):
+    try:
+        with open_raw(fpath) as f:
+            data = pd.read_csv(f, sep=r'\s+', header=None, names=names, dtype=np.int64)
+    except pd.errors.EmptyDataError:
+        return np.zeros(0, dtype=[(name, 'i8') for name in names])
+    records = np.empty(len(data), dtype=[(name, 'i8') for name in names])
+    for name in names:
+        records[name] = data[name].values
+    return records
+
+
+ENC_KEYS = ['ts_s', 'ts_ns', 'encoder', 'counter', 'di']
+
+
+def parse_pizzabox_enc(fpath):
+    return _parse_pizzabox_ints(fpath, ENC_KEYS)
+
+
+DI_KEYS = ['ts_s', 'ts_ns', 'encoder', 'index', 'di']
+
+
+def parse_pizzabox_di(fpath):
+    return _parse_pizzabox_ints(fpath, DI_KEYS)
+
+
+# byte offsets of the chunk starts in pizzabox text files, keyed by
+# (path, size, mtime, chunk_size)
+_pizzabox_chunk_offsets = {}
+
+
+def pizzabox_chunk_offsets(fpath, chunk_size, block_size=2**24):
+    '''
+    Return the byte offsets where each chunk of chunk_size lines starts,
+    followed by the end of the file, so chunk k is offsets[k]:offsets[k+1].
+
+    The index is built with a single pass over the file in blocks and is
+    kept in-process until the file changes.
+    '''
+    st = raw_stat(fpath)
+    key = (os.path.abspath(fpath), st.st_size, st.st_mtime_ns, chunk_size)
+    if key in _pizzabox_chunk_offsets:
+        return _pizzabox_chunk_offsets[key]
+    offsets = [0]
+    pos = 0
+    # lines seen since the start of the current chunk
+    nlines = 0
+    with open_raw(fpath) as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+            # newlines that end the last line of a chunk
+            ends = newlines[chunk_size - nlines - 1::chunk_size]
+            offsets.extend((pos + ends + 1).tolist())
+            nlines = (nlines + len(newlines)) % chunk_size
+            pos += len(block)
+    if offsets[-1] != pos:
+        offsets.append(pos)
+    offsets = np.array(offsets, dtype=np.int64)
+    _pizzabox_chunk_offsets[key] = offsets
+    return offsets
+
+
 class PizzaBoxAnHandlerTxt(HandlerBase):
     def __init__(self, fpath, chunk_size=0):
         '''
@@ -19,27 +271,14 @@ class PizzaBoxAnHandlerTxt(HandlerBase):
         This combines the chunks together and ignores the chunk size to speed
             things up.
         '''
-        self.data = pd.read_csv(fpath, delimiter = " ", header=None)
-
-        ncols_tot = len(self.data.columns)
-        ncols = ncols_tot - 3
-        # ncols is additional cols, ncols_tot is ncols + 3
-        #print("total columns : {}".format(names))
-    
-        # now write names for columns
-        # for the rest, name them counts0, counts1 etc...
-        # create full list of columns
-        names =['time (s)', 'time (ns)', 'index']
-        names = names + [f'counts{i}' for i in range(ncols)]
-        chunk_cols = ['timestamp', 'index'] + [f'volts{j}' for j in range(ncols)]
-
-
-        self.data.columns = names
-        for j in range(ncols):
-            self.data[f'volts{j}'] = self.data[f'counts{j}'].apply(adc2counts)
+        records = load_pizzabox_records(fpath, 'an', parse_pizzabox_an)
+        ncols = len(records.dtype.names) - 3
 
-        self.data['timestamp'] = self.data['time (s)'] + 1e-9*self.data['time (ns)']
-        self.data = self.data[chunk_cols]
+        data = {'timestamp': records['ts_s'] + 1e-9 * records['ts_ns'],
+                'index': np.asarray(records['index'])}
+        for j in range(ncols):
+            data[f'volts{j}'] = adc_raw2volts(records[f'counts{j}'])
+        self.data = pd.DataFrame(data)
 
 
     def __call__(self, chunk_num, column=0):
@@ -56,31 +295,140 @@ class PizzaBoxAnHandlerTxt(HandlerBase):
 
 
 class PizzaBoxEncHandlerTxt(HandlerBase):
-    def __init__(self, fpath, chunk_size=0):
+    def __init__(self, fpath, chunk_size=0, streaming=False):
         '''
         adds the chunks of data to a list
         This combines the chunks together and ignores the chunk size to speed
             things up.
+
+        With the 'streaming' resource kwarg (written by EncoderFS with
+        streaming = True, which then makes one datum per chunk) nothing is
+        loaded up front and each call reads only the rows of its chunk, so
+        memory is bounded by chunk_size. Resources with a single chunk_num=0
+        datum must not be read this way, they would lose all rows after the
+        first chunk.
         '''
-        keys = ['times', 'timens', 'encoder', 'counter', 'di']
-        self.data = pd.read_csv(fpath, delimiter = " ", header=None)
-        self.data.columns = keys
-        #self.data = pd.read_table(fpath, delim_whitespace=True, comment='#', names=keys, index_col=False)
-        self.data['timestamp'] = self.data['times'] + 1e-9 * self.data['timens']
-        self.data['encoder'] = self.data['encoder'].apply(lambda x: int(x) if int(x) <= 0 else -(int(x) ^ 0xffffff - 1))
-        self.data = self.data[['timestamp', 'counter', 'encoder']]
+        self.fpath = fpath
+        self.chunk_size = chunk_size
+        self.streaming = streaming
+        if self.streaming and self.chunk_size:
+            self.data = None
+            return
+        records = load_pizzabox_records(fpath, 'enc', parse_pizzabox_enc)
+        self.data = self._to_frame(records)
+
+    @staticmethod
+    def _to_frame(records):
+        return pd.DataFrame({'timestamp': np.asarray(records['ts_s'] + 1e-9 * records['ts_ns']),
+                             'counter': np.asarray(records['counter']),
+                             'encoder': enc2counts_array(records['encoder'])})
 
+    def _read_chunk(self, chunk_num):
+        cs = self.chunk_size
+        records = cached_pizzabox_records(self.fpath, 'enc')
+        if records is not None:
+            return self._to_frame(records[chunk_num*cs:(chunk_num+1)*cs])
+        offsets = pizzabox_chunk_offsets(self.fpath, cs)
+        if chunk_num + 1 >= len(offsets):
+            return self._to_frame(parse_pizzabox_enc(io.BytesIO(b'')))
+        start, stop = offsets[chunk_num], offsets[chunk_num + 1]
+        with open_raw(self.fpath) as f:
+            f.seek(start)
+            raw = f.read(stop - start)
+        return self._to_frame(parse_pizzabox_enc(io.BytesIO(raw)))
 
     def __call__(self, chunk_num):
         '''
         returns specified chunk number/index from list of all chunks created
         '''
+        if self.data is None:
+            return self._read_chunk(chunk_num)
         columns = ['timestamp', 'counter', 'encoder']
         if chunk_num == 0:
             return self.data
         else:
             return pd.DataFrame(columns=columns)
 
+    def iter_chunks(self):
+        '''
+        Yield the whole file as consecutive DataFrames of chunk_size rows,
+        reading the text only once.
+        '''
+        cs = self.chunk_size or 2**20
+        records = cached_pizzabox_records(self.fpath, 'enc')
+        if records is not None:
+            for start in range(0, len(records), cs):
+                yield self._to_frame(records[start:start + cs])
+            return
+        with open_raw(self.fpath) as f:
+            reader = pd.read_csv(f, sep=r'\s+', header=None, names=ENC_KEYS,
+                                 dtype=np.int64, chunksize=cs)
+            for chunk in reader:
+                yield self._to_frame(chunk)
+
+
+# Packed binary form of a pizzabox encoder file, written by
+# transcode_pizzabox_enc next to the text file (EncoderFS.binary_output).
+PIZZABOX_ENC_BIN_DTYPE = np.dtype([('timestamp_ns', '<i8'), ('encoder', '<i4'), ('counter', '<i4')])
+PIZZABOX_ENC_BIN_SUFFIX = '.bin'
+
+
+def transcode_pizzabox_enc(fpath, bin_fpath=None):
+    '''
+    Write the rows of a pizzabox encoder text file into a packed binary file
+    of PIZZABOX_ENC_BIN_DTYPE records (timestamp in ns, encoder counts,
+    counter), by default next to the text file with a .bin suffix.
+
+    Returns the path of the binary file.
+    '''
+    if bin_fpath is None:
+        bin_fpath = fpath + PIZZABOX_ENC_BIN_SUFFIX
+    records = load_pizzabox_records(fpath, 'enc', parse_pizzabox_enc)
+    encoder = enc2counts_array(records['encoder'])
+    for name, values in (('encoder', encoder), ('counter', records['counter'])):
+        if values.size and (values.min() < np.iinfo(np.int32).min or values.max() > np.iinfo(np.int32).max):
+            raise ValueError(f'{name} values of {fpath} do not fit in int32')
+    packed = np.empty(len(records), dtype=PIZZABOX_ENC_BIN_DTYPE)
+    packed['timestamp_ns'] = records['ts_s'] * 1_000_000_000 + records['ts_ns']
+    packed['encoder'] = encoder
+    packed['counter'] = records['counter']
+    with atomic_write_path(bin_fpath) as tmp_fpath:
+        packed.tofile(tmp_fpath)
+    return bin_fpath
+
+
+class PizzaBoxEncHandlerBin(HandlerBase):
+    '''
+    Read the packed encoder files written by transcode_pizzabox_enc through
+    a memory map. Returns the same frames as PizzaBoxEncHandlerTxt without
+    parsing any text.
+    '''
+    def __init__(self, fpath, chunk_size=0):
+        self.fpath = fpath
+        self.chunk_size = chunk_size
+        self.records = read_raw_array(fpath, PIZZABOX_ENC_BIN_DTYPE)
+
+    @staticmethod
+    def _to_frame(records):
+        ts_s, ts_ns = np.divmod(records['timestamp_ns'], 1_000_000_000)
+        return pd.DataFrame({'timestamp': ts_s + 1e-9 * ts_ns,
+                             'counter': records['counter'].astype(np.int64),
+                             'encoder': records['encoder'].astype(np.int64)})
+
+    def __call__(self, chunk_num):
+        '''
+        returns specified chunk number/index from list of all chunks created
+        '''
+        if chunk_num == 0:
+            return self._to_frame(self.records)
+        else:
+            return pd.DataFrame(columns=['timestamp', 'counter', 'encoder'])
+
+    def iter_chunks(self):
+        cs = self.chunk_size or 2**20
+        for start in range(0, len(self.records), cs):
+            yield self._to_frame(self.records[start:start + cs])
+
 
 # TODO : move upstream
 #class PizzaBoxEncHandlerTxt(HandlerBase):
@@ -99,17 +447,25 @@ class PizzaBoxEncHandlerTxt(HandlerBase):
 
 
 class PizzaBoxDIHandlerTxt(HandlerBase):
-    di_row = namedtuple('di_row', ['ts_s', 'ts_ns', 'encoder', 'index', 'di'])
     "Read PizzaBox text files using info from filestore."
     def __init__(self, fpath, chunk_size):
+        self.fpath = fpath
         self.chunk_size = chunk_size
-        with open(fpath, 'r') as f:
-            self.lines = list(f)
 
     def __call__(self, chunk_num):
+        '''
+        returns the rows of the chunk as a record array with fields
+        ts_s, ts_ns, encoder, index and di
+        '''
         cs = self.chunk_size
-        return [self.di_row(*(int(v) for v in ln.split()))
-                for ln in self.lines[chunk_num*cs:(chunk_num+1)*cs]]
+        offsets = pizzabox_chunk_offsets(self.fpath, cs)
+        if chunk_num + 1 >= len(offsets):
+            return np.rec.array(parse_pizzabox_di(io.BytesIO(b'')))
+        start, stop = offsets[chunk_num], offsets[chunk_num + 1]
+        with open_raw(self.fpath) as f:
+            f.seek(start)
+            raw = f.read(stop - start)
+        return np.rec.array(parse_pizzabox_di(io.BytesIO(raw)))
 
 
 #class PizzaBoxAnHandlerTxt(HandlerBase):
@@ -160,6 +516,8 @@ db.reg.register_handler('PIZZABOX_AN_FILE_TXT',
                         PizzaBoxAnHandlerTxt, overwrite=True)
 db.reg.register_handler('PIZZABOX_ENC_FILE_TXT',
                         PizzaBoxEncHandlerTxt, overwrite=True)
+db.reg.register_handler('PIZZABOX_ENC_FILE_BIN',
+                        PizzaBoxEncHandlerBin, overwrite=True)
 db.reg.register_handler('PIZZABOX_DI_FILE_TXT',
                         PizzaBoxDIHandlerTxt, overwrite=True)
 db.reg.register_handler(QASXspress3HDF5Handler.HANDLER_NAME,
@@ -5,6 +5,7 @@ import time as ttime
 # import uuid
 from collections import deque
 
+import h5py
 import numpy as np
 
 from ophyd import Component as Cpt, Device, EpicsSignal, EpicsSignalRO, Kind
@@ -488,7 +489,187 @@ class APBBinFileHandler(HandlerBase):
         return self.df
 
 
+APB_COLUMNS = ['timestamp', 'i0', 'it', 'ir', 'iff', 'aux1', 'aux2', 'aux3', 'aux4']
+# one row of an electrometer *.bin file: 8 channels, then the timestamp seconds
+# and the nanoseconds counter
+APB_RAW_DTYPE = np.dtype([(name, '<i4') for name in APB_COLUMNS[1:]] +
+                         [('ts_s', '<i4'), ('ts_ns', '<i4')])
+
+# The streamed channels are in uV, the ch{n}_offset values recorded by
+# get_md_for_scan are the apb_ave means in mV.
+APB_COUNTS_PER_VOLT = 1e6
+APB_OFFSET_TO_COUNTS = 1e3
+# keithley_gains{B,C} in the start document list the amplifier gains (as
+# powers of ten, V/A) of the channels wired to i0, it, ir (and iff in hutch B).
+APB_GAINS_KEYS = {'b': 'keithley_gainsB', 'c': 'keithley_gainsC'}
+
+
+def apb_calibration(start):
+    '''
+    Return the channel offsets (in mV) and amplifier gains (as powers of ten)
+    recorded in the start document of a fly scan as two {column: value} dicts.
+
+    Channels without an amplifier get a gain of 0, i.e. they are only
+    converted to volts.
+    '''
+    channels = APB_COLUMNS[1:]
+    offsets = {name: float(start.get(f'ch{i + 1}_offset', 0)) for i, name in enumerate(channels)}
+    gains = dict.fromkeys(channels, 0.0)
+    gains_key = APB_GAINS_KEYS.get(start.get('hutch') or 'b', 'keithley_gainsB')
+    gains.update(zip(channels, map(float, start.get(gains_key) or [])))
+    return offsets, gains
+
+
+# Downsampled min/max/mean of every channel, one level per factor, written
+# next to the raw file for quick-look plots of whole scans.
+APB_PYRAMID_FACTORS = (16, 256, 4096)
+APB_PYRAMID_SUFFIX = '.pyramid.h5'
+
+
+def _reduce_bins(mins, maxs, sums, step):
+    starts = np.arange(0, len(mins), step)
+    if not starts.size:
+        return starts, mins, maxs, sums
+    return (starts,
+            np.minimum.reduceat(mins, starts),
+            np.maximum.reduceat(maxs, starts),
+            np.add.reduceat(sums, starts, dtype=np.float64))
+
+
+def build_apb_pyramid(fpath, overwrite=False):
+    '''
+    Write the quick-look pyramid of an electrometer *.bin file into
+    <fpath>.pyramid.h5: for every factor in APB_PYRAMID_FACTORS a group with
+    the start time and sample count of each bin and <channel>_min/_max/_mean.
+
+    Every level is reduced from the previous one, channel by channel, so
+    the raw file is read once and never as a whole.
+    Returns the path of the pyramid file.
+    '''
+    pyramid_path = fpath + APB_PYRAMID_SUFFIX
+    if os.path.exists(pyramid_path) and not overwrite:
+        return pyramid_path
+    raw_data = read_raw_array(fpath, APB_RAW_DTYPE)
+    timestamp = raw_data['ts_s'] + raw_data['ts_ns'] * 8.0051232 * 1e-9
+    with atomic_write_path(pyramid_path) as tmp_path, h5py.File(tmp_path, 'w') as f:
+        f.attrs['num_samples'] = len(raw_data)
+        f.attrs['factors'] = APB_PYRAMID_FACTORS
+        groups, prev_factor = [], 1
+        for factor in APB_PYRAMID_FACTORS:
+            starts = np.arange(0, len(raw_data), factor)
+            group = f.create_group(str(factor))
+            group['timestamp'] = timestamp[starts]
+            group['count'] = np.diff(np.append(starts, len(raw_data)))
+            groups.append((group, factor // prev_factor))
+            prev_factor = factor
+        for name in APB_COLUMNS[1:]:
+            values = raw_data[name]
+            mins, maxs, sums = values, values, values
+            for group, step in groups:
+                _, mins, maxs, sums = _reduce_bins(mins, maxs, sums, step)
+                for suffix, data in (('min', mins), ('max', maxs),
+                                     ('mean', (sums / group['count'][()]).astype(np.float32))):
+                    group.create_dataset(f'{name}_{suffix}', data=data, compression='lzf', shuffle=True)
+    return pyramid_path
+
+
+class APBBinFileMemmapHandler(HandlerBase):
+    """
+    Read electrometer *.bin files through a memory map.
+
+    The file is never loaded as a whole: only the requested columns are
+    converted to float64, so reading just 'timestamp', 'i0' and 'it' of a
+    multi-GB stream costs about the size of those three columns. Archived
+    files (see archive_run) are decompressed into memory instead.
+    """
+    def __init__(self, fpath, columns=None):
+        self.fpath = fpath
+        self.columns = columns
+        self._calibrated = {}
+        self.raw_data = read_raw_array(fpath, APB_RAW_DTYPE)
+
+    def prefetch(self):
+        '''
+        Pull the file into the page cache, so that the columns read later
+        from the memory map do not wait on the file system.
+        '''
+        if isinstance(self.raw_data, np.memmap):
+            warm_raw_file(self.fpath)
+
+    def column(self, name):
+        if name == 'timestamp':
+            # Unix timestamp with nanoseconds
+            return self.raw_data['ts_s'] + self.raw_data['ts_ns'] * 8.0051232 * 1e-9
+        return self.raw_data[name].astype(np.float64)
+
+    def __call__(self, columns=None):
+        columns = columns or self.columns or APB_COLUMNS
+        return pd.DataFrame({name: self.column(name) for name in columns}, columns=columns)
+
+    def quicklook(self, num_points=2000, t0=None, t1=None, columns=None):
+        '''
+        Return <channel>_min/_max/_mean of the channels between t0 and t1
+        (Unix timestamps, the whole stream by default) from the coarsest
+        pyramid level that still has num_points bins in that window. The
+        pyramid is built on the first call if it was not written when the run
+        stopped. If no level is fine enough, or the pyramid cannot be written
+        (e.g. a read-only archive), the raw samples are reduced to about
+        num_points bins instead.
+        '''
+        channels = [name for name in (columns or self.columns or APB_COLUMNS) if name != 'timestamp']
+        try:
+            f = h5_file_pool.get(build_apb_pyramid(self.fpath))
+            factors = sorted(f.attrs['factors'], reverse=True)
+        except OSError as e:
+            print(f'Cannot use the quick-look pyramid of {self.fpath}, reading the raw data: {e!r}')
+            factors = []
+        for factor in factors:
+            group = f[str(factor)]
+            timestamp = group['timestamp'][()]
+            start = max(np.searchsorted(timestamp, t0, side='right') - 1, 0) if t0 is not None else 0
+            stop = np.searchsorted(timestamp, t1, side='right') if t1 is not None else timestamp.size
+            if stop - start >= num_points:
+                data = {'timestamp': timestamp[start:stop]}
+                for name, suffix in itertools.product(channels, ('min', 'max', 'mean')):
+                    data[f'{name}_{suffix}'] = group[f'{name}_{suffix}'][start:stop]
+                return pd.DataFrame(data)
+        timestamp = self.column('timestamp')
+        start = np.searchsorted(timestamp, t0) if t0 is not None else 0
+        stop = np.searchsorted(timestamp, t1, side='right') if t1 is not None else timestamp.size
+        step = max((stop - start) // max(num_points, 1), 1)
+        starts = np.arange(start, stop, step)
+        count = np.diff(np.append(starts, stop))
+        data = {'timestamp': timestamp[starts]}
+        for name in channels:
+            values = self.raw_data[name][start:stop]
+            _, mins, maxs, sums = _reduce_bins(values, values, values, step)
+            data.update({f'{name}_min': mins, f'{name}_max': maxs,
+                         f'{name}_mean': (sums / count).astype(np.float32)})
+        return pd.DataFrame(data)
+
+    def calibrated(self, offsets, gains, columns=None):
+        '''
+        Return the channels as currents in A, (counts - offset) / 10**gain,
+        together with the timestamp.
+
+        offsets and gains are {column: value} as returned by apb_calibration.
+        All requested channels are converted in one vectorized pass and the
+        result is kept on the handler, so every consumer of the same resource
+        with the same calibration gets the same DataFrame.
+        '''
+        channels = [name for name in (columns or self.columns or APB_COLUMNS) if name != 'timestamp']
+        key = tuple((name, offsets.get(name, 0), gains.get(name, 0)) for name in channels)
+        if key not in self._calibrated:
+            idx = [APB_COLUMNS.index(name) - 1 for name in channels]
+            raw = self.raw_data.view('<i4').reshape(-1, len(APB_RAW_DTYPE.names))[:, idx]
+            offset = np.array([offsets.get(name, 0) for name in channels]) * APB_OFFSET_TO_COUNTS
+            scale = APB_COUNTS_PER_VOLT * 10.0 ** np.array([gains.get(name, 0) for name in channels])
+            data = (raw - offset) / scale
+            df = pd.DataFrame(data, columns=channels)
+            df.insert(0, 'timestamp', self.column('timestamp'))
+            self._calibrated[key] = df
+        return self._calibrated[key]
 
 
 db.reg.register_handler('APB',
-                        APBBinFileHandler, overwrite=True)
+                        APBBinFileMemmapHandler, overwrite=True)
@@ -156,7 +156,7 @@ apb_trigger_pil900k = AnalogPizzaBoxTrigger(prefix="XF:07BMB-CT{PBA:1}:Pulse:2:"
 class APBTriggerFileHandler(HandlerBase):
     "Read APB trigger *.bin files"
     def __init__(self, fpath):
-        raw_data = np.fromfile(fpath, dtype=np.int32)
+        raw_data = read_raw_array(fpath, np.int32)
         raw_data = raw_data.reshape((raw_data.size // 3, 3))
         columns = ['timestamp', 'transition']
         derived_data = np.zeros((raw_data.shape[0], 2))
@@ -165,10 +165,71 @@ class APBTriggerFileHandler(HandlerBase):
 
         self.df = pd.DataFrame(data=derived_data, columns=columns)
         self.raw_data = raw_data
+        self._edges = None
 
     def __call__(self):
         return self.df
 
+    def _compute_edges(self):
+        transition = self.raw_data[:, 0]
+        # Unix timestamp in integer nanoseconds
+        ts_ns = self.raw_data[:, 1].astype(np.int64) * 1_000_000_000 + \
+                np.rint(self.raw_data[:, 2] * 8.0051232).astype(np.int64)
+        level = transition > 0
+        # keep only rows where the level actually changes
+        changed = np.ones(level.size, dtype=bool)
+        changed[1:] = level[1:] != level[:-1]
+        rising = ts_ns[changed & level]
+        falling = ts_ns[changed & ~level]
+        # each frame runs from its rising edge to the first falling edge after it
+        idx = np.searchsorted(falling, rising, side='right')
+        ends = np.full(rising.size, -1, dtype=np.int64)
+        ends[idx < falling.size] = falling[idx[idx < falling.size]]
+        self._edges = (rising, falling, np.stack([rising, ends], axis=1))
+
+    @property
+    def rising_edges(self):
+        "Rising-edge times in int64 nanoseconds, one per frame."
+        if self._edges is None:
+            self._compute_edges()
+        return self._edges[0]
+
+    @property
+    def falling_edges(self):
+        "Falling-edge times in int64 nanoseconds."
+        if self._edges is None:
+            self._compute_edges()
+        return self._edges[1]
+
+    @property
+    def frame_windows(self):
+        "(num_frames, 2) int64 array of exposure [start, stop] in nanoseconds, stop is -1 if never closed."
+        if self._edges is None:
+            self._compute_edges()
+        return self._edges[2]
+
+    @property
+    def num_frames(self):
+        return self.rising_edges.size
+
+    def frame_window(self, frame):
+        "Return the (start, stop) exposure window of a frame in nanoseconds."
+        start, stop = self.frame_windows[frame]
+        return int(start), int(stop)
+
+    def frame_at(self, timestamp):
+        """
+        Return the index of the frame whose exposure started last at or before
+        timestamp (int nanoseconds, or float seconds), -1 if before the first.
+        Accepts scalars or arrays. Float seconds only resolve ~0.5 us at
+        present-day epoch values, so pass nanoseconds for exact matching.
+        """
+        timestamp = np.asarray(timestamp)
+        if timestamp.dtype.kind == 'f':
+            timestamp = np.rint(timestamp * 1e9).astype(np.int64)
+        frame = np.searchsorted(self.rising_edges, timestamp, side='right') - 1
+        return int(frame) if frame.ndim == 0 else frame
+
 
 
 
@@ -29,10 +29,34 @@ import numpy as np
 import itertools
 import time as ttime
 from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import warnings
 
 
-class Xspress3FileStoreFlyable(Xspress3FileStore):
+class FrameChunkedHDF5Mixin:
+    """
+    Make the HDF5 plugin write chunks of chunk_frames whole frames (all
+    channels x all bins) instead of the IOC default, so that frame-sequential
+    reads (QASXspress3HDF5Handler.iter_blocks) decompress every chunk once.
+    Set chunk_frames = None to keep the IOC settings.
+    """
+    chunk_frames = 64
+
+    def stage(self):
+        if self.chunk_frames:
+            height = self.array_size.height.get()
+            width = self.array_size.width.get()
+            chunk_sigs = [(self.num_frames_chunks, self.chunk_frames)]
+            if height and width:
+                chunk_sigs += [(self.num_row_chunks, height), (self.num_col_chunks, width)]
+            # the chunking must be set before capture starts
+            self.stage_sigs = OrderedDict(chunk_sigs + [(sig, value) for sig, value in self.stage_sigs.items()
+                                                        if sig not in dict(chunk_sigs)])
+        return super().stage()
+
+
+class Xspress3FileStoreFlyable(FrameChunkedHDF5Mixin, Xspress3FileStore):
     def warmup(self):
         """
         A convenience method for 'priming' the plugin.
@@ -329,7 +353,133 @@ def xs_count(acq_time: float = 1, num_frames: int = 1):
     yield from bp.count([xs], acq_time)
 
 
-class QASXspress3DetectorStream(QASXspress3Detector):
+XS3_MCA_DATA_KEY = '/entry/instrument/detector/data'
+
+
+def xs3_reduce_mca(mca, rebin=1, window=None):
+    """
+    Crop the MCA spectra (last axis) to the bins window[0]..window[1]-1 and
+    sum every rebin neighbouring bins.
+    """
+    lo, hi = window if window is not None else (0, mca.shape[-1])
+    if (hi - lo) % rebin:
+        raise ValueError(f'The window of {hi - lo} bins is not a multiple of rebin={rebin}')
+    mca = mca[..., lo:hi]
+    if rebin == 1:
+        return mca
+    return mca.reshape(mca.shape[:-1] + ((hi - lo) // rebin, rebin)).sum(axis=-1, dtype=mca.dtype)
+
+
+def reduce_xspress3_file(fpath, rebin=1, window=None, key=XS3_MCA_DATA_KEY, frames_per_read=1024):
+    """
+    Rewrite an Xspress3 file with its MCA spectra reduced by xs3_reduce_mca.
+    The ROI attributes and everything else are copied unchanged, links to the
+    spectra (e.g. /entry/data/data) point to the reduced dataset. The reduced
+    dataset keeps the frame chunks of the original and carries the mca_rebin
+    and mca_window attributes, files that have them are left alone.
+    """
+    key = '/' + key.lstrip('/')
+    with h5py.File(fpath, 'r') as src:
+        dataset = src[key]
+        if 'mca_rebin' in dataset.attrs:
+            return fpath
+        window = tuple(window) if window is not None else (0, dataset.shape[-1])
+        shape = dataset.shape[:-1] + ((window[1] - window[0]) // rebin,)
+        frames = dataset.chunks[0] if dataset.chunks else FrameChunkedHDF5Mixin.chunk_frames or 64
+        chunks = (max(min(frames, shape[0]), 1),) + shape[1:]
+        mca_addr = h5py.h5o.get_info(dataset.id).addr
+
+        def copy_dataset(item, dst, name):
+            if h5py.h5o.get_info(item.id).addr != mca_addr:
+                item.parent.copy(item, dst, name=name)
+                return
+            out = dst.create_dataset(name, shape=shape, dtype=dataset.dtype, chunks=chunks,
+                                     compression='lzf', shuffle=True)
+            for attr_name, value in dataset.attrs.items():
+                out.attrs[attr_name] = value
+            out.attrs['mca_rebin'] = rebin
+            out.attrs['mca_window'] = window
+            for start in range(0, dataset.shape[0], frames_per_read):
+                out[start:start + frames_per_read] = xs3_reduce_mca(dataset[start:start + frames_per_read],
+                                                                    rebin, window)
+
+        with atomic_write_path(fpath) as tmp_fpath, h5py.File(tmp_fpath, 'w') as dst:
+            copy_hdf5_group(src, dst, copy_dataset)
+    h5_file_pool.release(fpath)
+    return fpath
+
+
+def _reduce_xspress3_files(fpaths, rebin, window):
+    for fpath in fpaths:
+        try:
+            reduce_xspress3_file(fpath, rebin, window)
+        except Exception as e:
+            warnings.warn(f'Could not reduce the spectra in {fpath}: {e!r}')
+
+
+# The files are rewritten one at a time in the background, so that collect
+# does not hold up the RunEngine while large files are copied.
+xs3_reduce_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='xs3-reduce')
+
+
+class Xspress3MCAReduceMixin:
+    """
+    Reduce the MCA spectra of a fly scan after it is complete (see
+    reduce_xspress3_file), e.g. 4096 -> 1024 bins with mca_rebin = 4, or
+    keep only an energy window with mca_window = (bin_low, bin_high). The
+    ROI values computed by the IOC are not affected.
+
+    The reduction is recorded in the resource kwargs, so the handler returns
+    reduced spectra even if rewriting the file failed.
+    """
+    mca_rebin = 1
+    mca_window = None
+
+    def set_mca_reduction(self, rebin=1, window=None):
+        width = self.hdf5.array_size.width.get()
+        lo, hi = window if window is not None else (0, width)
+        if not 0 <= lo < hi <= width or (hi - lo) % rebin:
+            raise ValueError(f'Cannot rebin the bins {lo}..{hi} of {width} by {rebin}')
+        self.mca_rebin = rebin
+        self.mca_window = None if window is None else (lo, hi)
+
+    def _mca_reduction(self):
+        if self.mca_rebin == 1 and self.mca_window is None:
+            return None
+        return {'mca_rebin': self.mca_rebin,
+                'mca_window': None if self.mca_window is None else list(self.mca_window)}
+
+    def complete(self, *args, **kwargs):
+        self._mca_reduced = False
+        return super().complete(*args, **kwargs)
+
+    def _mca_width(self, width):
+        lo, hi = self.mca_window or (0, width)
+        return (hi - lo) // self.mca_rebin
+
+    def _reduce_mca_files(self):
+        """
+        Record the reduction in the queued resources and rewrite their files
+        on xs3_reduce_pool, once per complete(). Until a file is rewritten the
+        handler reduces the spectra when reading them.
+        """
+        reduction = self._mca_reduction()
+        if reduction is None or getattr(self, '_mca_reduced', True):
+            return
+        self._mca_reduced = True
+        fpaths = []
+        for i, (name, doc) in enumerate(list(self._asset_docs_cache)):
+            if name != 'resource':
+                continue
+            fpaths.append(os.path.join(doc['root'], doc['resource_path']))
+            self._asset_docs_cache[i] = ('resource', {**doc, 'resource_kwargs': {**doc['resource_kwargs'],
+                                                                                 **reduction}})
+        if fpaths:
+            xs3_reduce_pool.submit(_reduce_xspress3_files, fpaths, reduction['mca_rebin'],
+                                   reduction['mca_window'])
+
+
+class QASXspress3DetectorStream(Xspress3MCAReduceMixin, QASXspress3Detector):
 
     def stage(self, acq_rate, traj_time, *args, **kwargs):
         self.hdf5.file_write_mode.put(2)  # put it to Stream |||| IS ALREADY STREAMING
@@ -353,7 +503,7 @@ class QASXspress3DetectorStream(QASXspress3Detector):
                                              'shape': [self.settings.num_images.get(),
                                                        # self.settings.array_counter.get()
                                                        self.hdf5.array_size.height.get(),
-                                                       self.hdf5.array_size.width.get()],
+                                                       self._mca_width(self.hdf5.array_size.width.get())],
                                              'filename': f'{self.hdf5.full_file_name.get()}',
                                              'external': 'FILESTORE:'}}}
         return return_dict
@@ -376,6 +526,7 @@ class QASXspress3DetectorStream(QASXspress3Detector):
             # print(f"-------------------{ts}-------------------------------------")
 
     def collect_asset_docs(self):
+        self._reduce_mca_files()
         items = list(self._asset_docs_cache)
         self._asset_docs_cache.clear()
         for item in items:
@@ -390,40 +541,196 @@ import pandas as pd
 from databroker.assets.handlers import HandlerBase, Xspress3HDF5Handler
 
 
-class QASXspress3HDF5Handler(Xspress3HDF5Handler):
-
-    def __init__(self, *args, **kwargs):
+class _ReducedMCA:
+    '''
+    Array-like view of the reduced MCA spectra of a QASXspress3HDF5Handler
+    for dask: every slice is read through the handler, so it is reduced or
+    not depending on the file that is open when the slice is computed.
+    '''
+    def __init__(self, handler):
+        self.handler = handler
+        self.shape = handler._mca_shape()
+        self.dtype = handler._dataset.dtype
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        frames = key[0] if key else slice(None)
+        if not isinstance(frames, slice):
+            return self[(slice(frames, frames + 1),) + key[1:]][0]
+        start, stop, step = frames.indices(self.shape[0])
+        mca = self.handler._read_mca(start, max(start, stop))
+        return mca[(slice(None, None, step),) + key[1:]]
+
+
+class QASXspress3HDF5Handler(PooledH5FileMixin, Xspress3HDF5Handler):
+    roi_channels = [1, 2, 3, 4, 5, 6]
+    roi_numbers = [1, 2, 3, 4]
+    # Number of frames fetched with a single hyperslab read when the data are
+    # filled frame by frame (the Filler unpacks event pages into single
+    # events), so that a fly scan costs one read per block instead of one
+    # read per frame and channel. Blocks start on HDF5 chunk boundaries and
+    # span whole chunks.
+    frames_per_read = 1024
+    # ROI-only fill: return just the CHANnROIm NDAttributes and never touch
+    # the MCA dataset. Switch it for the session with
+    # QASXspress3HDF5Handler.roi_only = True, or for a single query with the
+    # xs3_roi_only() context manager.
+    roi_only = False
+
+    def __init__(self, *args, mca_rebin=1, mca_window=None, **kwargs):
         super().__init__(*args, **kwargs)
+        # MCA reduction recorded by Xspress3MCAReduceMixin, applied on read
+        # for files that were not rewritten
+        self._mca_rebin = mca_rebin
+        self._mca_window = mca_window
         self._roi_data = None
+        self._roi_columns = None
         self._num_channels = None
+        self._block_start = None
+        self._block = None
+        self._block_dataset = None
 
     def _get_dataset(
             self):  # readpout of the following stuff should be done only once, this is why I redefined _get_dataset method - Denis Leshchev Feb 9, 2021
-        # dealing with parent
-        super()._get_dataset()
+        # keep the h5py dataset instead of loading all MCA spectra into memory
+        # as the parent does, frames are read in blocks by _get_block
+        if self._dataset is None:
+            self._dataset = PooledH5Dataset(lambda: self._file[self._key])
 
         # finding number of channels
-        if self._num_channels is not None:
-            return
-        print('determening number of channels')
-        shape = self.dataset.shape
-        if len(shape) != 3:
-            raise RuntimeError(f'The ndim of the dataset is not 3, but {len(shape)}')
-        self._num_channels = shape[1]
+        if self._num_channels is None:
+            print('determening number of channels')
+            shape = self.dataset.shape
+            if len(shape) != 3:
+                raise RuntimeError(f'The ndim of the dataset is not 3, but {len(shape)}')
+            self._num_channels = shape[1]
 
+        self._get_roi_data()
+
+    def _get_roi_data(self):
         if self._roi_data is not None:
             return
         print('reading ROI data')
-        self.chanrois = [f'CHAN{c}ROI{r}' for c, r in product([1, 2, 3, 4, 5, 6], [1, 2, 3, 4])]
+        self.chanrois = [f'CHAN{c}ROI{r}' for c, r in product(self.roi_channels, self.roi_numbers)]
         _data_columns = [self._file['/entry/instrument/detector/NDAttributes'][chanroi][()] for chanroi in
                          self.chanrois]
         data_columns = np.vstack(_data_columns).T
         self._roi_data = pd.DataFrame(data_columns, columns=self.chanrois)
+        self._roi_columns = {chanroi: self._roi_data[chanroi].values for chanroi in self.chanrois}
+
+    def _needs_reduction(self, dataset):
+        # checked on the open dataset at every read: reduce_xspress3_file may
+        # replace the file with the reduced one while the handler is alive
+        return ((self._mca_rebin != 1 or self._mca_window is not None)
+                and 'mca_rebin' not in dataset.attrs)
+
+    def _read_mca(self, start, stop, dataset=None):
+        if dataset is None:
+            dataset = self._dataset.dataset
+        mca = dataset[start:stop]
+        if self._needs_reduction(dataset):
+            mca = xs3_reduce_mca(mca, self._mca_rebin, self._mca_window)
+        return mca
+
+    def _mca_shape(self):
+        dataset = self._dataset.dataset
+        if not self._needs_reduction(dataset):
+            return dataset.shape
+        width = xs3_reduce_mca(np.zeros((1, dataset.shape[-1])), self._mca_rebin, self._mca_window).shape[-1]
+        return dataset.shape[:-1] + (width,)
+
+    def _block_frames(self):
+        chunk_frames = (self._dataset.chunks or (1,))[0]
+        return max(self.frames_per_read // chunk_frames, 1) * chunk_frames
+
+    def _get_block(self, frame):
+        dataset = self._dataset.dataset
+        if (self._block is None or self._block_dataset is not dataset
+                or not (self._block_start <= frame < self._block_start + len(self._block))):
+            # the pool reopens the file after it is replaced, a block read
+            # from the old file is dropped
+            block_frames = self._block_frames()
+            self._block_start = frame - frame % (dataset.chunks or (1,))[0]
+            self._block = self._read_mca(self._block_start, self._block_start + block_frames, dataset)
+            self._block_dataset = dataset
+        return self._block[frame - self._block_start]
+
+    def get_mca_array(self):
+        """
+        All MCA spectra of the file as a lazy dask array of shape
+        (frames, channels, bins), chunked like the read blocks. Nothing is
+        read until a slice is computed.
+        """
+        import dask.array as da
+        self._get_dataset()
+        source = _ReducedMCA(self)
+        return da.from_array(source, chunks=(self._block_frames(),) + source.shape[1:], lock=True, name=False)
+
+    def get_roi_dataframe(self):
+        """
+        All CHANnROIm attributes of the file, one row per frame.
+        """
+        self._get_roi_data()
+        return self._roi_data
+
+    def iter_blocks(self, start=0, stop=None, roi_only=None):
+        """
+        Walk frames start..stop-1 in chunk order, yielding (first frame,
+        get_frames(...) of the block) for blocks aligned with the HDF5 chunks.
+        """
+        self._get_dataset()
+        stop = self._dataset.shape[0] if stop is None else stop
+        block_frames = self._block_frames()
+        block_start = start - start % (self._dataset.chunks or (1,))[0]
+        for block_start in range(block_start, stop, block_frames):
+            first = max(block_start, start)
+            yield first, self.get_frames(first, min(block_start + block_frames, stop), roi_only=roi_only)
+
+    def prefetch(self):
+        """
+        Read what the first fill needs: the ROI attributes and, unless in
+        ROI-only mode, the first block of spectra, after pulling the whole
+        file into the page cache.
+        """
+        self._get_roi_data()
+        if not self.roi_only:
+            warm_raw_file(self._filename)
+            self._get_dataset()
+            if self._dataset.shape[0]:
+                self._get_block(0)
+
+    def close(self):
+        self._block_start = None
+        self._block = None
+        self._block_dataset = None
+        super().close()
+
+    def get_frames(self, start, stop, roi_only=None):
+        """
+        Read frames start..stop-1 with one hyperslab read and return stacked
+        arrays: 'ch_n' -> (num_frames, num_bins) and 'CHANnROIm' -> (num_frames,).
+        roi_only overrides the class setting for this call.
+        """
+        if roi_only is None:
+            roi_only = self.roi_only
+        self._get_roi_data()
+        return_dict_rois = {chanroi: self._roi_columns[chanroi][start:stop] for chanroi in self.chanrois}
+        if roi_only:
+            return return_dict_rois
+        self._get_dataset()
+        mca = self._read_mca(start, stop)
+        return_dict = {f'ch_{i + 1}': mca[:, i, :] for i in range(self._num_channels)}
+        return {**return_dict, **return_dict_rois}
 
     def __call__(self, *args, frame=None, **kwargs):
+        if self.roi_only:
+            self._get_roi_data()
+            return {chanroi: self._roi_columns[chanroi][frame] for chanroi in self.chanrois}
         self._get_dataset()
-        return_dict = {f'ch_{i + 1}': self._dataset[frame, i, :] for i in range(self._num_channels)}
-        return_dict_rois = {chanroi: self._roi_data[chanroi][frame] for chanroi in self.chanrois}
+        mca = self._get_block(frame)
+        return_dict = {f'ch_{i + 1}': mca[i, :] for i in range(self._num_channels)}
+        return_dict_rois = {chanroi: self._roi_columns[chanroi][frame] for chanroi in self.chanrois}
         return {**return_dict, **return_dict_rois}
 
 
@@ -432,44 +739,22 @@ db.reg.register_handler(QASXspress3HDF5Handler.HANDLER_NAME,
                         QASXspress3HDF5Handler, overwrite=True)
 
 
-class QASXspress3HDF5Handler_light(Xspress3HDF5Handler):
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._roi_data = None
-        self._num_channels = None
-
-    def _get_dataset(
-            self):  # readpout of the following stuff should be done only once, this is why I redefined _get_dataset method - Denis Leshchev Feb 9, 2021
-        # dealing with parent
-        # super()._get_dataset()
-
-        # finding number of channels
-        # if self._num_channels is not None:
-        #     return
-        # print('determening number of channels')
-        # shape = self.dataset.shape
-        # if len(shape) != 3:
-        #     raise RuntimeError(f'The ndim of the dataset is not 3, but {len(shape)}')
-        # self._num_channels = shape[1]
-
-        if self._roi_data is not None:
-            return
-        print('reading ROI data')
-        self.chanrois = [f'CHAN{c}ROI{r}' for c, r in product([1, 2, 3, 4, 5, 6], [1, 2, 3, 4])]
-        _data_columns = [self._file['/entry/instrument/detector/NDAttributes'][chanroi][()] for chanroi in
-                         self.chanrois]
-        data_columns = np.vstack(_data_columns).T
-        self._roi_data = pd.DataFrame(data_columns, columns=self.chanrois)
-
-    def __call__(self, *args, frame=None, **kwargs):
-        self._get_dataset()
-        # return_dict = {f'ch_{i+1}' : self._dataset[frame, i, :] for i in range(self._num_channels)}
-        return_dict_rois = {chanroi: self._roi_data[chanroi][frame] for chanroi in self.chanrois}
-        # return {**return_dict, **return_dict_rois}
-        return return_dict_rois
+@contextmanager
+def xs3_roi_only(roi_only=True):
+    """
+    Fill Xspress3 and Xspress3X resources with the ROI attributes only, e.g.
 
-    # db.reg.register_handler(QASXspress3HDF5Handler_light.HANDLER_NAME,
-    #                         QASXspress3HDF5Handler_light, overwrite=True)
+        with xs3_roi_only():
+            hdr.table(stream_name='xs_stream', fill=True)
+    """
+    previous = QASXspress3HDF5Handler.roi_only
+    QASXspress3HDF5Handler.roi_only = roi_only
+    try:
+        yield
+    finally:
+        QASXspress3HDF5Handler.roi_only = previous
 
 
+# light-weight file handler, kept for code that refers to it by name
+class QASXspress3HDF5Handler_light(QASXspress3HDF5Handler):
+    roi_only = True
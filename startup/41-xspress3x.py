@@ -34,7 +34,7 @@ import warnings
 from databroker.assets.handlers import XS3_XRF_DATA_KEY as XRF_DATA_KEY
 
 
-class Xspress3FileStoreFlyable(Xspress3FileStore):
+class Xspress3FileStoreFlyable(FrameChunkedHDF5Mixin, Xspress3FileStore):
     def warmup(self):
         """
         A convenience method for 'priming' the plugin.
@@ -500,7 +500,7 @@ def xsx_count(acq_time: float = 1, num_frames: int = 1):
     yield from bp.count([xsx], acq_time)
 
 
-class QASXspress3XDetectorStream(QASXspress3XDetector):
+class QASXspress3XDetectorStream(Xspress3MCAReduceMixin, QASXspress3XDetector):
 
     def stage(self, acq_rate, traj_time, *args, **kwargs):
         self.hdf5.file_write_mode.put(2)  # put it to Stream |||| IS ALREADY STREAMING
@@ -524,7 +524,7 @@ class QASXspress3XDetectorStream(QASXspress3XDetector):
                                              'shape': [self.settings.num_images.get(),
                                                        # self.settings.array_counter.get()
                                                        self.hdf5.array_size.height.get(),
-                                                       self.hdf5.array_size.width.get()],
+                                                       self._mca_width(self.hdf5.array_size.width.get())],
                                              'filename': f'{self.hdf5.full_file_name.get()}',
                                              'external': 'FILESTORE:'}}}
         return return_dict
@@ -547,6 +547,7 @@ class QASXspress3XDetectorStream(QASXspress3XDetector):
             # print(f"-------------------{ts}-------------------------------------")
 
     def collect_asset_docs(self):
+        self._reduce_mca_files()
         items = list(self._asset_docs_cache)
         self._asset_docs_cache.clear()
         for item in items:
@@ -561,41 +562,8 @@ import pandas as pd
 from databroker.assets.handlers import HandlerBase, Xspress3HDF5Handler
 
 
-class QASXspress3XHDF5Handler(Xspress3HDF5Handler):
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._roi_data = None
-        self._num_channels = None
-
-    def _get_dataset(
-            self):  # readpout of the following stuff should be done only once, this is why I redefined _get_dataset method - Denis Leshchev Feb 9, 2021
-        # dealing with parent
-        super()._get_dataset()
-
-        # finding number of channels
-        if self._num_channels is not None:
-            return
-        print('determening number of channels')
-        shape = self.dataset.shape
-        if len(shape) != 3:
-            raise RuntimeError(f'The ndim of the dataset is not 3, but {len(shape)}')
-        self._num_channels = shape[1]
-
-        if self._roi_data is not None:
-            return
-        print('reading ROI data')
-        self.chanrois = [f'CHAN{c}ROI{r}' for c, r in product([1, 2, 3, 4, 5, 6, 7, 8], [1, 2, 3, 4])]
-        _data_columns = [self._file['/entry/instrument/detector/NDAttributes'][chanroi][()] for chanroi in
-                         self.chanrois]
-        data_columns = np.vstack(_data_columns).T
-        self._roi_data = pd.DataFrame(data_columns, columns=self.chanrois)
-
-    def __call__(self, *args, frame=None, **kwargs):
-        self._get_dataset()
-        return_dict = {f'ch_{i + 1}': self._dataset[frame, i, :] for i in range(self._num_channels)}
-        return_dict_rois = {chanroi: self._roi_data[chanroi][frame] for chanroi in self.chanrois}
-        return {**return_dict, **return_dict_rois}
+class QASXspress3XHDF5Handler(QASXspress3HDF5Handler):
+    roi_channels = [1, 2, 3, 4, 5, 6, 7, 8]
 
 
 # heavy-weight file handler
@@ -616,12 +616,12 @@ def pil_count(acq_time: int = 1, num_frames: int = 1, open_shutter: bool = True)
 from itertools import product
 
 import pandas as pd
-from databroker.assets.handlers import AreaDetectorTiffHandler, HandlerBase, PilatusCBFHandler, Xspress3HDF5Handler, AreaDetectorHDF5SWMRHandler
+from databroker.assets.handlers import AreaDetectorTiffHandler, HandlerBase, PilatusCBFHandler, Xspress3HDF5Handler, AreaDetectorHDF5SWMRHandler, ImageStack
 # Note: the databroker is v0 and follows the old code path, so it uses databroker.assets.handlers.AreaDetectorHDF5SWMRHandler.
 # from area_detector_handlers.handlers import AreaDetectorHDF5SWMRHandler
 
 
-class QASAreaDetectorHDF5SWMRHandler(AreaDetectorHDF5SWMRHandler):
+class QASAreaDetectorHDF5SWMRHandler(PooledH5FileMixin, AreaDetectorHDF5SWMRHandler):
     '''
     The reason we need this custom handles is that the reference to `self._dataset` is not refreshed correctly,
     so we redefine `self._dataset` on every call.
@@ -696,10 +696,50 @@ class QASAreaDetectorHDF5SWMRHandler(AreaDetectorHDF5SWMRHandler):
     File h5py/_selector.pyx:151, in h5py._selector.Selector.apply_args()
 
     IndexError: Index (1) out of range for (0-0)
+
+    Instead of re-resolving the dataset on every call, the handle is kept
+    open and refreshed only when a requested frame is past its last known
+    shape. The dataset is opened with a chunk cache that holds
+    `cache_frames` whole frames, the h5py default of 1 MB is smaller than
+    a single Pilatus 900k frame.
+
+    The file comes from h5_file_pool, the dataset is reopened with the same
+    chunk cache if the pool has closed the file in between.
     '''
+    cache_frames = 4
+    h5_swmr = True
+
+    def _open_dataset(self):
+        import h5py
+        dataset = self._file[self._key]
+        if dataset.chunks is None:
+            return dataset
+        chunk_nbytes = int(np.prod(dataset.chunks)) * dataset.dtype.itemsize
+        chunks_per_frame = int(np.prod([-(-n // c) for n, c in zip(dataset.shape[1:], dataset.chunks[1:])]))
+        num_chunks = chunks_per_frame * -(-self.cache_frames // dataset.chunks[0])
+        # HDF5 reuses an already open dataset together with its access
+        # properties, so the probe handle has to be closed before reopening
+        del dataset
+        dapl = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+        # w0=1: evict chunks that have been read completely first, frames are read in order
+        dapl.set_chunk_cache(100 * num_chunks + 1, num_chunks * chunk_nbytes, 1.0)
+        return h5py.Dataset(h5py.h5d.open(self._file.id, self._key.encode(), dapl=dapl))
+
     def __call__(self, point_number):
-        self._dataset = self._file["/entry/data/data"]
-        return super().__call__(point_number)
+        start = point_number * self._fpp
+        stop = start + self._fpp
+        if self._dataset is None:
+            self._dataset = PooledH5Dataset(self._open_dataset)
+        if self._dataset.shape[0] < stop:
+            self._dataset.refresh()
+        if point_number not in self._data_objects:
+            self._data_objects[point_number] = ImageStack(self._dataset, start, stop)
+        return self._data_objects[point_number]
+
+    def close(self):
+        self._dataset = None
+        self._data_objects = {}
+        super().close()
 
 
 db.reg.register_handler('AD_HDF5_SWMR',
@@ -775,3 +815,266 @@ db.reg.register_handler('AD_HDF5_SWMR',
 # db.reg.register_handler('PIL900k_HDF5',
 #                          QASPilatusHDF5Handler, overwrite=True)
 
+
+
+PILATUS_HDF5_IMAGE_KEY = 'entry/data/data'
+PILATUS_HDF5_ROI_KEY = 'entry/instrument/NDAttributes'
+PILATUS_HDF5_SPARSE_KEY = 'entry/data/sparse'
+PILATUS_SPARSE_SUFFIX = '.sparse.h5'
+
+
+def pilatus_sparse_path(fpath):
+    return os.path.splitext(fpath)[0] + PILATUS_SPARSE_SUFFIX
+
+
+class SparseFrameStack:
+    '''
+    Pilatus frames stored CSR-style by sparsify_pilatus_file.
+
+    Every frame starts from a base frame that holds the pixels with the same
+    non-zero value in all frames of the first read block (module gaps, dead
+    pixels), then frame i sets counts[indptr[i]:indptr[i + 1]] at the flat
+    pixel indices indices[indptr[i]:indptr[i + 1]].
+
+    Indexing returns dense frames like an h5py dataset, ROI and azimuthal
+    sums are computed from the stored entries without densifying.
+    '''
+    chunks = None
+    ndim = 3
+
+    def __init__(self, open_group):
+        self._open_group = open_group
+        group = open_group()
+        self.shape = tuple(int(n) for n in group.attrs['shape'])
+        self.dtype = np.dtype(group.attrs['dtype'])
+        self.indptr = group['indptr'][()]
+        self.base_indices = group['base_indices'][()]
+        self.base_counts = group['base_counts'][()]
+        self._base = np.zeros(int(np.prod(self.shape[1:])), dtype=self.dtype)
+        self._base[self.base_indices] = self.base_counts
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _entries(self, start, stop):
+        group = self._open_group()
+        lo, hi = self.indptr[start], self.indptr[stop]
+        rows = np.repeat(np.arange(stop - start), np.diff(self.indptr[start:stop + 1]))
+        return rows, group['indices'][lo:hi], group['counts'][lo:hi]
+
+    def frames(self, start, stop):
+        rows, indices, counts = self._entries(start, stop)
+        out = np.tile(self._base, (stop - start, 1))
+        out[rows, indices] = counts
+        return out.reshape((stop - start,) + self.shape[1:])
+
+    def frame(self, i):
+        return self.frames(i, i + 1)[0]
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        first, rest = key[0], key[1:]
+        if isinstance(first, (int, np.integer)):
+            i = range(len(self))[first]
+            return self.frame(i)[rest]
+        start, stop, step = first.indices(len(self))
+        return self.frames(start, max(start, stop))[::step][(slice(None),) + rest]
+
+    def bin_sums(self, bin_map, num_bins, frames_per_read=1024):
+        '''
+        Return the (num_frames, num_bins) sums of the counts of every frame
+        over the pixels of each bin. bin_map has the frame shape and gives
+        the bin of each pixel, negative for pixels to leave out.
+        '''
+        bin_map = np.asarray(bin_map).ravel()
+        in_base = bin_map[self.base_indices] >= 0
+        base_sums = np.bincount(bin_map[self.base_indices][in_base],
+                                weights=self.base_counts[in_base], minlength=num_bins)
+        out = np.empty((len(self), num_bins))
+        for start in range(0, len(self), frames_per_read):
+            stop = min(start + frames_per_read, len(self))
+            rows, indices, counts = self._entries(start, stop)
+            bins = bin_map[indices]
+            ok = bins >= 0
+            # stored entries replace the base value of their pixel
+            weights = counts[ok].astype(np.float64) - self._base[indices[ok]]
+            out[start:stop] = np.bincount(rows[ok] * num_bins + bins[ok], weights=weights,
+                                          minlength=(stop - start) * num_bins).reshape(-1, num_bins)
+        return out + base_sums
+
+    def roi_sum(self, roi):
+        '''
+        Per-frame sum over a ROI, given as a boolean mask of the frame shape
+        or as (row_start, row_stop, column_start, column_stop).
+        '''
+        if isinstance(roi, tuple):
+            mask = np.zeros(self.shape[1:], dtype=bool)
+            mask[roi[0]:roi[1], roi[2]:roi[3]] = True
+        else:
+            mask = np.asarray(roi, dtype=bool)
+        return self.bin_sums(np.where(mask, 0, -1), 1)[:, 0]
+
+    def azimuthal_sum(self, bin_map, num_bins):
+        '''
+        Per-frame sums over the azimuthal (e.g. q or 2theta) bins given by
+        bin_map, see bin_sums.
+        '''
+        return self.bin_sums(bin_map, num_bins)
+
+
+def sparsify_pilatus_file(fpath, sparse_fpath=None, frames_per_read=64, overwrite=False):
+    '''
+    Write the image stack of a PilatusStreamHDF5 file in the sparse layout
+    read by SparseFrameStack, together with a copy of the ROI NDAttributes,
+    into <file>.sparse.h5. The frames are read once, in blocks.
+
+    QASPilatusHDF5Handler reads the sparse file instead of the original as
+    soon as it exists. Returns the path of the sparse file.
+    '''
+    if sparse_fpath is None:
+        sparse_fpath = pilatus_sparse_path(fpath)
+    if os.path.exists(sparse_fpath) and not overwrite:
+        return sparse_fpath
+    with h5py.File(fpath, 'r') as src, atomic_write_path(sparse_fpath) as tmp_fpath, h5py.File(tmp_fpath, 'w') as dst:
+        dataset = src[PILATUS_HDF5_IMAGE_KEY]
+        num_frames = dataset.shape[0]
+        group = dst.create_group(PILATUS_HDF5_SPARSE_KEY)
+        group.attrs['shape'] = dataset.shape
+        group.attrs['dtype'] = dataset.dtype.str
+        indices = group.create_dataset('indices', shape=(0,), maxshape=(None,), dtype=np.uint32,
+                                       chunks=(2**18,), compression='lzf', shuffle=True)
+        counts = group.create_dataset('counts', shape=(0,), maxshape=(None,), dtype=dataset.dtype,
+                                      chunks=(2**18,), compression='lzf', shuffle=True)
+        indptr = [np.zeros(1, dtype=np.int64)]
+        base = np.zeros(int(np.prod(dataset.shape[1:])), dtype=dataset.dtype)
+        for start in range(0, num_frames, frames_per_read):
+            block = dataset[start:start + frames_per_read].reshape(-1, base.size)
+            if start == 0:
+                constant = (block != 0).all(axis=0) & (block == block[0]).all(axis=0)
+                base[constant] = block[0, constant]
+            rows, columns = np.nonzero(block != base)
+            nnz = indices.shape[0]
+            indices.resize((nnz + rows.size,))
+            indices[nnz:] = columns
+            counts.resize((nnz + rows.size,))
+            counts[nnz:] = block[rows, columns]
+            indptr.append(indptr[-1][-1] + np.cumsum(np.bincount(rows, minlength=block.shape[0])))
+        group['indptr'] = np.concatenate(indptr)
+        group['base_indices'] = np.flatnonzero(base).astype(np.uint32)
+        group['base_counts'] = base[base != 0]
+        if PILATUS_HDF5_ROI_KEY in src:
+            src.copy(src[PILATUS_HDF5_ROI_KEY], dst.require_group(os.path.dirname(PILATUS_HDF5_ROI_KEY)),
+                     name=os.path.basename(PILATUS_HDF5_ROI_KEY))
+    return sparse_fpath
+
+
+class QASPilatusHDF5Handler(PooledH5FileMixin, HandlerBase):
+    '''
+    Handler for the files written by PilatusStreamHDF5 (spec 'PILATUS_HDF5').
+
+    Datums are {'data_type': 'image', 'roi_num': 0} for the image stack and
+    {'data_type': 'roi', 'roi_num': n} for the ROI totals. The image stack is
+    returned as a lazy dask array whose chunks are aligned with the HDF5
+    chunks, the ROI vectors are read from the small NDAttribute datasets
+    only, so the image data is not touched unless the image is requested.
+
+    If the file has been converted with sparsify_pilatus_file, the sparse
+    file is read instead and the image stack is densified chunk by chunk.
+    roi_sum and azimuthal_sum then work on the stored pixels only.
+    '''
+    specs = {'PILATUS_HDF5'} | HandlerBase.specs
+    HANDLER_NAME = 'PILATUS_HDF5'
+
+    # target size of one dask chunk, a whole number of HDF5 chunks along the frame axis
+    dask_chunk_nbytes = 64 * 2**20
+
+    def __init__(self, filename):
+        self._filename = filename
+        self.sparse = os.path.exists(pilatus_sparse_path(filename))
+        if self.sparse:
+            self._filename = pilatus_sparse_path(filename)
+        self._stack = None
+        self._images = None
+        self._roi_data = {}
+
+    def close(self):
+        self._stack = None
+        self._images = None
+        self._roi_data = {}
+        super().close()
+
+    def _dask_chunks(self, dataset):
+        chunks = dataset.chunks or (1,) + dataset.shape[1:]
+        frame_nbytes = int(np.prod(dataset.shape[1:])) * dataset.dtype.itemsize
+        frames = max(self.dask_chunk_nbytes // max(frame_nbytes * chunks[0], 1), 1) * chunks[0]
+        # split the frame axis on HDF5 chunk boundaries, keep whole frames in each dask chunk
+        return (frames,) + dataset.shape[1:]
+
+    def get_stack(self):
+        '''
+        The image stack as an h5py dataset, or a SparseFrameStack for sparse files.
+        '''
+        if self._stack is None:
+            if self.sparse:
+                self._stack = SparseFrameStack(lambda: self._file[PILATUS_HDF5_SPARSE_KEY])
+            else:
+                self._stack = PooledH5Dataset(lambda: self._file[PILATUS_HDF5_IMAGE_KEY])
+        return self._stack
+
+    def get_images(self):
+        import dask.array as da
+        if self._images is None:
+            dataset = self.get_stack()
+            self._images = da.from_array(dataset, chunks=self._dask_chunks(dataset), lock=True, name=False)
+        return self._images
+
+    def _dense_bin_sums(self, bin_map, num_bins, frames_per_read=64):
+        bin_map = np.asarray(bin_map).ravel()
+        ok = bin_map >= 0
+        stack = self.get_stack()
+        sums = []
+        for start in range(0, len(stack), frames_per_read):
+            block = stack[start:start + frames_per_read].reshape(-1, bin_map.size)[:, ok]
+            rows = np.repeat(np.arange(block.shape[0]), block.shape[1])
+            sums.append(np.bincount(rows * num_bins + np.tile(bin_map[ok], block.shape[0]),
+                                    weights=block.ravel(), minlength=block.shape[0] * num_bins))
+        return np.concatenate(sums).reshape(-1, num_bins)
+
+    def roi_sum(self, roi):
+        '''
+        Per-frame sum over a ROI, see SparseFrameStack.roi_sum.
+        '''
+        if self.sparse:
+            return self.get_stack().roi_sum(roi)
+        shape = self.get_stack().shape[1:]
+        if isinstance(roi, tuple):
+            mask = np.zeros(shape, dtype=bool)
+            mask[roi[0]:roi[1], roi[2]:roi[3]] = True
+        else:
+            mask = np.asarray(roi, dtype=bool)
+        return self._dense_bin_sums(np.where(mask, 0, -1), 1)[:, 0]
+
+    def azimuthal_sum(self, bin_map, num_bins):
+        '''
+        Per-frame sums over the bins of bin_map, see SparseFrameStack.bin_sums.
+        '''
+        if self.sparse:
+            return self.get_stack().azimuthal_sum(bin_map, num_bins)
+        return self._dense_bin_sums(bin_map, num_bins)
+
+    def get_roi(self, roi_num):
+        if roi_num not in self._roi_data:
+            self._roi_data[roi_num] = self._file[f'{PILATUS_HDF5_ROI_KEY}/_ROI{roi_num}Total'][()]
+        return self._roi_data[roi_num]
+
+    def __call__(self, data_type='image', roi_num=None):
+        if data_type == 'image':
+            return self.get_images()
+        elif data_type == 'roi':
+            return self.get_roi(roi_num)
+        else:
+            raise KeyError(f'data_type={data_type} not supported')
+
+
+db.reg.register_handler('PILATUS_HDF5',
+                         QASPilatusHDF5Handler, overwrite=True)
@@ -0,0 +1,146 @@
+print(__file__)
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Bounded pool used to open all files of a run in parallel. The handlers are
+# built through db.reg, so the instances end up in handler_cache (see
+# 09-handler-cache.py) and the Filler gets them from there when it reaches the
+# datums, instead of opening the files one after another.
+resource_prefetch_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='resource-prefetch')
+
+# Prefetch the files of every successful run as soon as it stops, so that the
+# first plot after the run does not wait on Lustre. Off by default, as it
+# reads all files of a run while the next scan is running.
+prefetch_runs_on_stop = False
+
+
+def _as_header(hdr):
+    '''
+    Return the Header of a run given as a Header or a uid.
+    '''
+    return db[hdr] if isinstance(hdr, str) else hdr
+
+
+def iter_stream_resources(hdr):
+    '''
+    Yield (stream name, data key, resource document) for every resource
+    referenced by the external data keys of a run, as soon as the first
+    event that references it is read.
+
+    All events are looked at, as a data key may switch to a new resource
+    (e.g. a new file) during a run. ophyd datum ids start with the uid of
+    their resource, so the datums of a resource already seen are not looked
+    up again.
+    '''
+    stream_names = set()
+    for descriptor in hdr.descriptors:
+        stream_name = descriptor.get('name', 'primary')
+        external_keys = [key for key, data_key in descriptor['data_keys'].items()
+                         if data_key.get('external')]
+        if not external_keys or stream_name in stream_names:
+            continue
+        stream_names.add(stream_name)
+        seen = set()
+        for event in hdr.events(stream_name=stream_name, fields=external_keys, fill=False):
+            for key in external_keys:
+                datum_id = event['data'].get(key)
+                if datum_id is None or (key, datum_id.split('/')[0]) in seen:
+                    continue
+                resource = db.reg.resource_given_datum_id(datum_id)
+                new = (key, resource['uid']) not in seen
+                seen.update({(key, datum_id.split('/')[0]), (key, resource['uid'])})
+                if new:
+                    yield stream_name, key, resource
+
+
+def run_stream_resources(hdr):
+    '''
+    Return the (stream name, data key, resource document) of
+    iter_stream_resources as a list, in the order of the events that first
+    reference them.
+    '''
+    return list(iter_stream_resources(hdr))
+
+
+def run_resources(hdr):
+    '''
+    Return the resource documents referenced by a run as {uid: resource}.
+    '''
+    return {resource['uid']: resource for _, _, resource in iter_stream_resources(hdr)}
+
+
+def run_resource_documents(hdr):
+    '''
+    Return every resource document inserted by a run as {uid: resource}.
+
+    Unlike run_resources, this walks the documents of the run, so it also
+    finds the resources that are not referenced by an external data key of
+    the descriptors (e.g. files attached to the run by a flyer).
+    '''
+    return {doc['uid']: doc for name, doc in hdr.documents(fill=False) if name == 'resource'}
+
+
+def _prefetch_resource(resource):
+    handler = db.reg.get_spec_handler(resource['uid'])
+    prefetch = getattr(handler, 'prefetch', None)
+    if prefetch is not None:
+        prefetch()
+    return handler
+
+
+def _report_error(what):
+    def report(future):
+        if future.exception() is not None:
+            print(f'{what} failed: {future.exception()!r}')
+    return report
+
+
+def _submit_on_stop(flag_name, fn, what, pool):
+    '''
+    Return a callback for 'stop' documents that submits fn(run start uid) to
+    pool after every successful run while the global flag_name is true.
+    Failures are printed as "<what> failed: <exception>".
+    '''
+    def on_stop(name, doc):
+        if globals()[flag_name] and doc.get('exit_status') == 'success':
+            future = pool.submit(fn, doc['run_start'])
+            future.add_done_callback(_report_error(what))
+    return on_stop
+
+
+def prefetch_run(hdr, wait=False):
+    '''
+    Open every file referenced by a run in parallel on resource_prefetch_pool.
+
+    Parameters
+    ----------
+    hdr : Header or str
+        header or uid of the run
+    wait : bool, optional
+        block until all files are loaded and return {resource uid: handler};
+        otherwise return {resource uid: future} right away
+
+    Example:
+        hdr = db[-1]
+        prefetch_run(hdr)
+        apb_df = hdr.table(stream_name='apb_stream', fill=True)
+    '''
+    hdr = _as_header(hdr)
+    futures = {}
+    # every file is submitted as soon as its resource is found, while the
+    # remaining events of the run are still being read
+    for _, _, resource in iter_stream_resources(hdr):
+        if resource['uid'] in futures:
+            continue
+        future = resource_prefetch_pool.submit(_prefetch_resource, resource)
+        future.add_done_callback(_report_error('Prefetching a resource'))
+        futures[resource['uid']] = future
+    if wait:
+        return {uid: future.result() for uid, future in futures.items()}
+    return futures
+
+
+prefetch_on_stop = _submit_on_stop('prefetch_runs_on_stop', prefetch_run, 'Prefetching a run',
+                                   resource_prefetch_pool)
+RE.subscribe(prefetch_on_stop, name='stop')
@@ -0,0 +1,339 @@
+print(__file__)
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+import pandas as pd
+
+
+# specs of the raw streams that have a columnar form
+COLUMNAR_SPECS = {'APB', 'APB_TRIGGER', 'PIZZABOX_ENC_FILE_TXT', 'PIZZABOX_ENC_FILE_BIN',
+                  'PIZZABOX_AN_FILE_TXT', 'XSP3'}
+
+
+def _raw_stream_tables(spec, handler):
+    '''
+    Return {table suffix: {column: 1d array}} for the raw data behind one
+    resource of one of the COLUMNAR_SPECS.
+    '''
+    if spec == 'APB':
+        df = handler()
+    elif spec == 'PIZZABOX_ENC_FILE_TXT':
+        df = handler.data
+        if df is None:
+            # streaming resource, each call returns one chunk of the file
+            df = pd.concat(list(handler.iter_chunks()) or [handler(0)], ignore_index=True)
+    elif spec == 'PIZZABOX_ENC_FILE_BIN':
+        df = handler(0)
+    elif spec == 'PIZZABOX_AN_FILE_TXT':
+        df = handler.data
+    elif spec == 'APB_TRIGGER':
+        windows = handler.frame_windows
+        return {'': {name: handler.df[name].values for name in handler.df.columns},
+                '_frames': {'start_ns': windows[:, 0], 'stop_ns': windows[:, 1]}}
+    elif spec == 'XSP3':
+        return {'': handler.get_frames(0, None, roi_only=True)}
+    else:
+        raise ValueError(f'No columnar form for spec {spec!r}')
+    return {'': {name: df[name].values for name in df.columns}}
+
+
+def _column_stats(values):
+    if values.size == 0 or values.dtype.kind not in 'iuf':
+        return {'count': values.size}
+    return {'count': values.size,
+            'min': np.nanmin(values),
+            'max': np.nanmax(values),
+            'mean': np.nanmean(values),
+            'std': np.nanstd(values)}
+
+
+def export_run_columnar(hdr, fpath=None, overwrite=False):
+    '''
+    Merge the raw streams of a fly scan into one columnar HDF5 file.
+
+    Every stream with external data (APB, encoder, trigger, Xspress3 ROIs)
+    becomes a group of equally long, typed 1d datasets, chunked and
+    compressed, with count/min/max/mean/std of each column stored as dataset
+    attributes. The trigger stream gets an extra '<stream>_frames' group with
+    the exposure window of every frame. Image and spectrum streams are skipped.
+
+    Parameters
+    ----------
+    hdr : Header or str
+        header or uid of the run
+    fpath : str, optional
+        output file, next to the interpolated file (interp_filename with an
+        .h5 extension) by default
+    overwrite : bool, optional
+        replace an existing export
+
+    Returns
+    -------
+    fpath : str
+    '''
+    hdr = _as_header(hdr)
+    if fpath is None:
+        fpath = os.path.splitext(hdr.start['interp_filename'])[0] + '.h5'
+    if os.path.exists(fpath) and not overwrite:
+        raise FileExistsError(f'{fpath} already exists, use overwrite=True to replace it')
+
+    with atomic_write_path(fpath) as tmp_fpath, h5py.File(tmp_fpath, 'w') as f:
+        for key in ('uid', 'scan_id', 'name', 'element', 'edge', 'e0', 'time'):
+            if hdr.start.get(key) is not None:
+                f.attrs[key] = hdr.start[key]
+        for stream_name, key, resource in run_stream_resources(hdr):
+            spec = resource['spec']
+            if spec not in COLUMNAR_SPECS:
+                continue
+            tables = _raw_stream_tables(spec, db.reg.get_spec_handler(resource['uid']))
+            for suffix, columns in tables.items():
+                group = f.create_group(stream_name + suffix)
+                group.attrs['data_key'] = key
+                group.attrs['spec'] = spec
+                group.attrs['resource'] = resource['uid']
+                group.attrs['columns'] = list(columns)
+                for name, values in columns.items():
+                    values = np.ascontiguousarray(values)
+                    dataset = group.create_dataset(name, data=values,
+                                                   chunks=(min(max(values.size, 1), 2**16),),
+                                                   compression='lzf', shuffle=True)
+                    for stat, value in _column_stats(values).items():
+                        dataset.attrs[stat] = value
+    return fpath
+
+
+def load_run_columnar(fpath, streams=None, columns=None):
+    '''
+    Read an export of export_run_columnar back as {stream name: DataFrame},
+    reading only the requested streams and columns.
+    '''
+    data = {}
+    with h5py.File(fpath, 'r') as f:
+        for stream_name in (streams or f.keys()):
+            group = f[stream_name]
+            names = [str(name) for name in group.attrs.get('columns', list(group.keys()))]
+            data[stream_name] = pd.DataFrame({name: group[name][()] for name in names
+                                              if columns is None or name in columns})
+    return data
+
+
+def load_apb_calibrated(hdr, stream_name='apb_stream', columns=None):
+    '''
+    Return the APB stream of a run as offset-subtracted, gain-scaled currents.
+
+    The offsets and gains are taken from the start document (see
+    apb_calibration). The conversion is kept on the cached handler of the
+    resource, so it runs once per run however many consumers ask for it.
+
+    Example:
+        df = load_apb_calibrated(db[-1], columns=['i0', 'it'])
+    '''
+    hdr = _as_header(hdr)
+    offsets, gains = apb_calibration(hdr.start)
+    for name, key, resource in iter_stream_resources(hdr):
+        if name == stream_name and resource['spec'] == 'APB':
+            handler = db.reg.get_spec_handler(resource['uid'])
+            return handler.calibrated(offsets, gains, columns=columns)
+    raise KeyError(f'No APB stream {stream_name!r} in run {hdr.start["uid"]}')
+
+
+def build_run_apb_pyramids(hdr, overwrite=False):
+    '''
+    Write the quick-look pyramid (see build_apb_pyramid) of every APB
+    stream of a run. Returns {stream name: pyramid path}.
+    '''
+    hdr = _as_header(hdr)
+    return {name: build_apb_pyramid(os.path.join(resource['root'], resource['resource_path']),
+                                    overwrite=overwrite)
+            for name, key, resource in run_stream_resources(hdr) if resource['spec'] == 'APB'}
+
+
+def apb_quicklook(hdr, stream_name='apb_stream', num_points=2000, t0=None, t1=None, columns=None):
+    '''
+    Return min/max/mean of an APB stream between t0 and t1 with at least
+    num_points rows, read from the coarsest pyramid level that has them.
+
+    Example:
+        df = apb_quicklook(db[-1], num_points=1000, columns=['i0', 'it'])
+    '''
+    hdr = _as_header(hdr)
+    for name, key, resource in iter_stream_resources(hdr):
+        if name == stream_name and resource['spec'] == 'APB':
+            handler = db.reg.get_spec_handler(resource['uid'])
+            return handler.quicklook(num_points=num_points, t0=t0, t1=t1, columns=columns)
+    raise KeyError(f'No APB stream {stream_name!r} in run {hdr.start["uid"]}')
+
+
+def xs3_run_data(hdr, data_key='xs_stream'):
+    '''
+    Return the MCA spectra of an Xspress3 or Xspress3X stream as one lazy
+    dask array (frames, channels, bins) and its ROI attributes as a
+    DataFrame, without filling the events frame by frame.
+
+    Example:
+        mca, rois = xs3_run_data(db[-1])
+        ch1_sum = mca[:, 0, :].sum(axis=0).compute()
+    '''
+    hdr = _as_header(hdr)
+    for name, key, resource in iter_stream_resources(hdr):
+        if key == data_key:
+            handler = db.reg.get_spec_handler(resource['uid'])
+            if not isinstance(handler, QASXspress3HDF5Handler):
+                raise TypeError(f'{data_key!r} is not an Xspress3 stream (spec {resource["spec"]!r})')
+            return handler.get_mca_array(), handler.get_roi_dataframe()
+    raise KeyError(f'No data key {data_key!r} in run {hdr.start["uid"]}')
+
+
+# dataset holding the frames in the files of each detector spec
+VDS_DATASET_KEYS = {'AD_HDF5': '/entry/data/data',
+                    'AD_HDF5_SWMR': '/entry/data/data',
+                    'PILATUS_HDF5': '/entry/data/data',
+                    'XSP3': '/entry/instrument/detector/data'}
+
+
+def run_detector_files(hdr, data_key):
+    '''
+    Return [(file path, dataset key)] of the files written for data_key
+    during a run, in the order of the events that reference them.
+    '''
+    stream_names = [descriptor.get('name', 'primary') for descriptor in hdr.descriptors
+                    if data_key in descriptor['data_keys']]
+    files = []
+    resource_uids = set()
+    for stream_name in dict.fromkeys(stream_names):
+        for event in hdr.events(stream_name=stream_name, fields=[data_key], fill=False):
+            datum_id = event['data'].get(data_key)
+            # ophyd datum ids are '<resource uid>/<n>', skip the lookup for known resources
+            if datum_id is None or datum_id.split('/')[0] in resource_uids:
+                continue
+            resource = db.reg.resource_given_datum_id(datum_id)
+            if resource['uid'] in resource_uids:
+                continue
+            resource_uids.add(resource['uid'])
+            if resource['spec'] not in VDS_DATASET_KEYS:
+                raise ValueError(f'No frame dataset known for spec {resource["spec"]!r}')
+            files.append((os.path.join(resource['root'], resource['resource_path']),
+                          VDS_DATASET_KEYS[resource['spec']]))
+    return files
+
+
+def build_run_vds(hdrs, data_key, fpath=None, overwrite=False):
+    '''
+    Write an HDF5 virtual dataset that stitches all frames of data_key
+    written during one run, or a series of runs (e.g. the energy points of
+    count_pilatus_qas_dafs), into one array. No data is copied, the
+    virtual dataset only maps onto the detector files.
+
+    The file holds 'data' (all frames along the first axis), 'file_start'
+    (index of the first frame of each source file), 'run_index' (run of
+    each source file) and the source paths and run uids as attributes.
+
+    Parameters
+    ----------
+    hdrs : Header, str or list of them
+        run(s) in the order their frames should appear
+    data_key : str
+        detector data key, e.g. 'pilatus_image' or 'xs_stream'
+    fpath : str, optional
+        output file, next to the first detector file by default
+    overwrite : bool, optional
+        replace an existing file
+
+    Returns
+    -------
+    fpath : str
+
+    Example:
+        fpath = build_run_vds(db[-40:], 'pilatus_image')
+        with h5py.File(fpath, 'r') as f:
+            roi = f['data'][:, 100:200, 300:400]
+    '''
+    if isinstance(hdrs, str) or hasattr(hdrs, 'start'):
+        hdrs = [hdrs]
+    hdrs = [_as_header(hdr) for hdr in hdrs]
+
+    sources = []
+    for run_index, hdr in enumerate(hdrs):
+        for path, key in run_detector_files(hdr, data_key):
+            with h5py.File(path, 'r') as f:
+                dataset = f[key]
+                sources.append((run_index, path, key, dataset.shape, dataset.dtype))
+    if not sources:
+        raise ValueError(f'No detector files for {data_key!r} in the given runs')
+    frame_shape, dtype = sources[0][3][1:], sources[0][4]
+    for _, path, _, shape, source_dtype in sources:
+        if shape[1:] != frame_shape or source_dtype != dtype:
+            raise ValueError(f'{path} has frames of {shape[1:]} {source_dtype}, '
+                             f'expected {frame_shape} {dtype}')
+
+    file_start = np.cumsum([0] + [shape[0] for _, _, _, shape, _ in sources])
+    layout = h5py.VirtualLayout(shape=(int(file_start[-1]),) + frame_shape, dtype=dtype)
+    for (_, path, key, shape, _), start in zip(sources, file_start):
+        layout[start:start + shape[0]] = h5py.VirtualSource(path, key, shape=shape)
+
+    if fpath is None:
+        fpath = os.path.join(os.path.dirname(sources[0][1]),
+                             f'{data_key}-{hdrs[0].start["uid"][:8]}-vds.h5')
+    if os.path.exists(fpath) and not overwrite:
+        raise FileExistsError(f'{fpath} already exists, use overwrite=True to replace it')
+    with atomic_write_path(fpath) as tmp_fpath, h5py.File(tmp_fpath, 'w', libver='latest') as f:
+        f.create_virtual_dataset('data', layout, fillvalue=0)
+        f['file_start'] = file_start[:-1]
+        f['run_index'] = np.array([run_index for run_index, *_ in sources])
+        f.attrs['data_key'] = data_key
+        f.attrs['files'] = [path for _, path, *_ in sources]
+        f.attrs['run_uids'] = [hdr.start['uid'] for hdr in hdrs]
+    return fpath
+
+
+def sparsify_pilatus_run(hdr, remove_dense=False):
+    '''
+    Convert the Pilatus files of a run to the sparse layout (see
+    sparsify_pilatus_file). The PILATUS_HDF5 handler reads the sparse file
+    from then on, so the run is loaded as before.
+
+    With remove_dense=True the original files are deleted once their sparse
+    copy is written. Returns {resource uid: sparse file path}.
+    '''
+    hdr = _as_header(hdr)
+    sparse = {}
+    for uid, resource in run_resources(hdr).items():
+        if resource['spec'] != 'PILATUS_HDF5':
+            continue
+        fpath = os.path.join(resource['root'], resource['resource_path'])
+        if not os.path.exists(fpath):
+            continue
+        sparse[uid] = sparsify_pilatus_file(fpath)
+        if remove_dense:
+            release_resource_handlers(resource)
+            os.remove(fpath)
+    return sparse
+
+
+# Export every successful run automatically after it stops. Off by default,
+# as it writes a file into the proposal directory for each run.
+export_runs_on_stop = False
+_run_export_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='run-export')
+export_on_stop = _submit_on_stop('export_runs_on_stop', export_run_columnar, 'Columnar export',
+                                 _run_export_pool)
+RE.subscribe(export_on_stop, name='stop')
+
+
+# Write the APB quick-look pyramids of every successful run when it stops.
+# Off by default, quicklook builds the pyramid of a file when it is first
+# asked for.
+build_pyramids_on_stop = False
+pyramids_on_stop = _submit_on_stop('build_pyramids_on_stop', build_run_apb_pyramids,
+                                   'Building the APB pyramid', _run_export_pool)
+RE.subscribe(pyramids_on_stop, name='stop')
+
+
+# Convert the Pilatus frames of every successful run to sparse files when it
+# stops. Off by default, the dense files are kept either way.
+sparsify_pilatus_on_stop = False
+sparsify_on_stop = _submit_on_stop('sparsify_pilatus_on_stop', sparsify_pilatus_run,
+                                   'Converting the Pilatus files', _run_export_pool)
+RE.subscribe(sparsify_on_stop, name='stop')
@@ -0,0 +1,73 @@
+# Compare the full-run read throughput of QASXspress3HDF5Handler on the
+# IOC default layout (one chunk per frame) and on the frame-aligned layout
+# written with FrameChunkedHDF5Mixin (chunk_frames frames x channels x bins).
+# 'h5py per frame' reads one frame at a time straight from h5py with the
+# default chunk cache, as code outside the handler does.
+#
+# Run it in the profile namespace, e.g.
+#     %run -i tests/benchmark_xs3_chunking.py
+import os
+import tempfile
+import time as ttime
+
+import h5py
+import numpy as np
+
+num_frames = 20000
+num_channels = 6
+num_bins = 4096
+chunk_frames = 64
+frames_per_write = 1000
+
+layouts = {'IOC default (1 frame per chunk)': (1, num_channels, num_bins),
+           f'frame-aligned ({chunk_frames} frames per chunk)': (chunk_frames, num_channels, num_bins)}
+
+
+def write_xs3_file(fpath, chunks, compression=None):
+    rng = np.random.default_rng(0)
+    key = XS3_MCA_DATA_KEY
+    with h5py.File(fpath, 'w') as f:
+        dataset = f.create_dataset(key, shape=(num_frames, num_channels, num_bins), dtype='<u4',
+                                   chunks=chunks, compression=compression)
+        for start in range(0, num_frames, frames_per_write):
+            n = min(frames_per_write, num_frames - start)
+            dataset[start:start + n] = rng.poisson(0.5, size=(n, num_channels, num_bins))
+        attrs = f.require_group('/entry/instrument/detector/NDAttributes')
+        for c, r in itertools.product(range(1, num_channels + 1), range(1, 5)):
+            attrs[f'CHAN{c}ROI{r}'] = rng.random(num_frames)
+
+
+def time_read(fpath, mode):
+    if mode == 'h5py per frame':
+        t0 = ttime.perf_counter()
+        with h5py.File(fpath, 'r') as f:
+            dataset = f[XS3_MCA_DATA_KEY]
+            for frame in range(num_frames):
+                dataset[frame]
+        return ttime.perf_counter() - t0
+    handler = QASXspress3HDF5Handler(fpath)
+    t0 = ttime.perf_counter()
+    if mode == 'handler per frame':
+        # the Filler path: one call per frame
+        for frame in range(num_frames):
+            handler(frame=frame)
+    else:
+        for _ in handler.iter_blocks():
+            pass
+    elapsed = ttime.perf_counter() - t0
+    handler.close()
+    h5_file_pool.release(fpath)
+    return elapsed
+
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    nbytes = num_frames * num_channels * num_bins * 4
+    for compression in (None, 'lzf'):
+        for name, chunks in layouts.items():
+            fpath = os.path.join(tmpdir, 'xs3.h5')
+            write_xs3_file(fpath, chunks, compression)
+            for mode in ('iter_blocks', 'handler per frame', 'h5py per frame'):
+                elapsed = time_read(fpath, mode)
+                print(f'{name:40} {str(compression):5} {mode:18}: {elapsed:7.2f} s, '
+                      f'{nbytes / elapsed / 2**20:8.1f} MB/s')
+            os.remove(fpath)